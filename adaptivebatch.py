@@ -0,0 +1,182 @@
+# Splits the regions of a run into batches whose size and number of
+# concurrent workers are tuned from the timings observed so far.
+#
+# The cost of a batch of n items is modelled as overhead + n * per_item,
+# where overhead is the cost of a round trip to PowerShell. Estimates are
+# saved per command so that later runs start out well tuned. Batches
+# running side by side may slow each other down, so workers are added one
+# at a time, for as long as each one makes the run go faster.
+from __future__ import with_statement
+import math
+import time
+import json
+import hashlib
+import threading
+
+import sublimepath
+
+# Batches are sized so that the round trip is at most this share of their
+# cost, but not so large that a batch takes longer than MAX_BATCH_SECONDS.
+TARGET_OVERHEAD_SHARE = 0.1
+MAX_BATCH_SECONDS = 2.0
+MAX_BATCH_SIZE = 5000
+# With no estimates yet, a single item measures the overhead and a batch
+# of PROBE_BATCH_SIZE items the cost per item.
+PROBE_BATCH_SIZE = 16
+# Runs of up to this many items are sent in one batch: splitting them up
+# would cost more round trips than it could save, and would restart the
+# pipeline's script state for each batch.
+SINGLE_BATCH_MAX_ITEMS = 4 * PROBE_BATCH_SIZE
+MAX_WORKERS = 4
+# How much more a worker must get through than it slows the others down
+# for it to be kept.
+MIN_WORKER_GAIN = 0.1
+MAX_SAVED_COMMANDS = 200
+
+
+def command_key(runner_name, cmd):
+    return hashlib.md5(("%s\n%s" % (runner_name, cmd)).encode('utf-8')).hexdigest()
+
+def load_estimates(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_estimates(path, estimates):
+    # Forget the commands that haven't been run for the longest time.
+    keys = sorted(estimates, key=lambda k: estimates[k]["used"], reverse=True)
+    for key in keys[MAX_SAVED_COMMANDS:]:
+        del estimates[key]
+    # Only atomic: losing the latest estimates in a crash costs little.
+    sublimepath.replaceFile(path, json.dumps(estimates), sync=False)
+
+
+class AdaptiveBatcher(object):
+    """
+    Hands out (start, count) batches of total items to up to max_workers
+    workers. Workers report how long each batch took with record(), and
+    later batches are sized from a least squares fit of the timings of
+    batches that ran alone. Set concurrent to False for runners that can
+    only serve one batch at a time, and split to False to hand out all of
+    the items in a single batch.
+    """
+
+    def __init__(self, total, key=None, path=None, max_workers=MAX_WORKERS, concurrent=True,
+                 split=True):
+        self.total = total
+        self.key = key
+        self.path = path
+        self.max_workers = max_workers if concurrent else 1
+        self.split = split
+        self.next = 0
+        self.running = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        # Sums for the least squares fit: samples, n, t, n*n, n*t.
+        self.sums = [0, 0.0, 0.0, 0.0, 0.0]
+        self.sizes = set()
+        self.overhead = self.per_item = None
+        # Most batches running at once while each batch in progress ran.
+        self.levels = {}
+        # Seconds taken and predicted by the fit, added up over the batches
+        # that ran alongside others, by the number of batches running.
+        self.slowdowns = {}
+        if path and key:
+            saved = load_estimates(path).get(key)
+            if saved:
+                self.overhead, self.per_item = saved["overhead"], saved["per_item"]
+
+    def record(self, batch, seconds):
+        """Report that batch, as handed out by next_batch(), took seconds."""
+        with self.lock:
+            self.running -= 1
+            count = batch[1]
+            level = self.levels.pop(batch, 1)
+            if level > 1:
+                if self.per_item is not None:
+                    taken, predicted = self.slowdowns.get(level, (0.0, 0.0))
+                    self.slowdowns[level] = (taken + seconds,
+                                             predicted + self.overhead + count * self.per_item)
+                return
+            k, sn, st, snn, snt = self.sums
+            self.sums = [k + 1, sn + count, st + seconds,
+                         snn + count * count, snt + count * seconds]
+            self.sizes.add(count)
+            # Two different batch sizes are needed to tell the overhead from
+            # the cost per item; until then, stick to the saved estimates.
+            if len(self.sizes) < 2:
+                return
+            k, sn, st, snn, snt = self.sums
+            per_item = max((k * snt - sn * st) / (k * snn - sn * sn), 0.0)
+            self.per_item = per_item
+            self.overhead = max((st - per_item * sn) / k, 0.0)
+
+    def batch_size(self):
+        remaining = self.total - self.next
+        if not self.split or self.total <= SINGLE_BATCH_MAX_ITEMS:
+            return remaining
+        if self.per_item is None:
+            return 1 if not self.sums[0] and not self.running else PROBE_BATCH_SIZE
+        if self.per_item == 0:
+            size = MAX_BATCH_SIZE
+        else:
+            size = self.overhead * (1 - TARGET_OVERHEAD_SHARE) / (TARGET_OVERHEAD_SHARE * self.per_item)
+            size = min(size, MAX_BATCH_SECONDS / self.per_item)
+        # Leave some work for every worker.
+        size = min(size, math.ceil(float(remaining) / self.workers()))
+        return int(max(1, min(size, MAX_BATCH_SIZE)))
+
+    def throughput(self, level):
+        """Items done with level batches running, relative to one alone."""
+        taken, predicted = self.slowdowns.get(level, (1.0, 1.0))
+        if not taken:
+            return float(level)
+        return level * predicted / taken
+
+    def workers(self):
+        """Number of workers worth keeping busy."""
+        if not self.split or self.per_item is None or self.total <= SINGLE_BATCH_MAX_ITEMS:
+            return 1
+        # Try one more worker than has been seen to pay off.
+        workers = 1
+        while workers < self.max_workers:
+            if workers + 1 not in self.slowdowns:
+                workers += 1
+                break
+            if (self.throughput(workers + 1) <
+                    self.throughput(workers) * (1 + MIN_WORKER_GAIN)):
+                break
+            workers += 1
+        return max(1, min(workers, self.total - self.next))
+
+    def next_batch(self, worker):
+        """
+        Return the next (start, count) batch for worker, a number below
+        max_workers, or None if it should stop.
+        """
+        with self.lock:
+            if self.stopped or self.next >= self.total or worker >= self.workers():
+                return None
+            count = min(self.batch_size(), self.total - self.next)
+            batch = self.next, count
+            self.next += count
+            self.running += 1
+            for other in self.levels:
+                self.levels[other] = max(self.levels[other], self.running)
+            self.levels[batch] = self.running
+            return batch
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+    def save(self):
+        if not (self.path and self.key) or self.per_item is None:
+            return
+        estimates = load_estimates(self.path)
+        estimates[self.key] = {"overhead": self.overhead,
+                               "per_item": self.per_item,
+                               "used": time.time()}
+        save_estimates(self.path, estimates)
@@ -6,6 +6,7 @@ push-location $root
 	# remove-item cmdlet doesn't work well!
 	get-childitem "." -recurse -filter "*.pyc" | remove-item
 	remove-item "dist" -recurse -force
+	remove-item "build" -recurse -force
 	remove-item "Doc" -recurse
 	remove-item "MANIFEST"
 pop-location
\ No newline at end of file
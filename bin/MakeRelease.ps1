@@ -23,7 +23,7 @@ push-location $root
 
 	# Ensure MANIFEST reflects all changes to file system.
 	remove-item ".\MANIFEST" -erroraction silentlycontinue
-	& ".\setup.py" "spa"
+	& ".\setup.py" "spa" "--deterministic"
 
 	(get-item ".\dist\PowershellUtils.sublime-package").fullname | clip.exe
 pop-location
@@ -1,39 +1,90 @@
 from __future__ import with_statement
 import os.path
-import subprocess
+import re
 import codecs
-import ctypes
 import tempfile
 import functools
-from xml.etree.ElementTree import ElementTree
+import threading
+import bisect
 import base64
+import mmap
+import time
+import array
+import Queue
+import traceback
 
 import sublime, sublime_plugin
 
 import sublimepath
+import poshrunner
+import poshtrace
+import adaptivebatch
 from sublime_lib.view import append
 
 # The PoSh pipeline provided by the user and the input values (regions)
-# are merged with this template.
+# are merged with this template. The result of each region is written to
+# stdout as soon as it's ready, as a frame on a line of its own:
+#   <out|err> <region index> <base64-encoded UTF-8 text>
 PoSh_SCRIPT_TEMPLATE = u"""
-function collectData { "<out><![CDATA[$([string]::join('`n', $input))]]></out>`n" }
-$script:pathToOutPutFile ="%s"
-"<outputs>" | out-file $pathToOutPutFile -encoding utf8 -force
+function writeFrame([string]$kind, [int]$index) {
+    $bytes = [Text.Encoding]::UTF8.GetBytes([string]::join("`n", $input))
+    [Console]::Out.WriteLine("$kind $index " + [Convert]::ToBase64String($bytes))
+    [Console]::Out.Flush()
+}
 $script:regionTexts = %s
-$script:regionTexts | foreach-object {
-                        %s | out-string | collectData | out-file `
-                                                    -filepath $pathToOutPutFile `
-                                                    -append `
-                                                    -encoding utf8
+$script:regionIndex = 0
+$script:regionErrorActionPreference = $ErrorActionPreference
+try {
+    $script:regionTexts | foreach-object {
+                            # Errors are caught per region so that the other
+                            # regions can still be processed.
+                            try {
+                                $ErrorActionPreference = "Stop"
+                                %s | out-string | writeFrame "out" $regionIndex
+                            }
+                            catch {
+                                $_ | out-string | writeFrame "err" $regionIndex
+                            }
+                            $script:regionIndex++
+    }
+}
+finally {
+    # In a session this runs in the session's global scope, so leave
+    # nothing of the template behind for the commands that follow.
+    $ErrorActionPreference = $script:regionErrorActionPreference
+    remove-item function:writeFrame
+    remove-variable regionTexts, regionIndex, regionErrorActionPreference -scope script
 }
-"</outputs>" | out-file $pathToOutPutFile -encoding utf8 -append -force
 """
+# The script is written in pieces around the values and the pipeline so
+# that it's never held in memory as a whole.
+PoSh_SCRIPT_HEAD, PoSh_SCRIPT_MIDDLE, PoSh_SCRIPT_TAIL = PoSh_SCRIPT_TEMPLATE.split("%s")
+FRAME_RE = re.compile(r"^(out|err) (\d+) ([A-Za-z0-9+/=]*)\s*$")
 
 THIS_PACKAGE_NAME = "PowershellUtils"
 THIS_PACKAGE_DEV_NAME = "XXX" + THIS_PACKAGE_NAME
 POSH_SCRIPT_FILE_NAME = "psbuff.ps1"
 POSH_HISTORY_DB_NAME = "pshist.txt"
-OUTPUT_SINK_NAME = "out.xml"
+POSH_BATCH_DB_NAME = "psbatch.json"
+POSH_TRACE_FILE_NAME = "pstrace.jsonl"
+FAILED_REGIONS_KEY = "powershell.failed"
+PENDING_REGIONS_KEY = "powershell.pending"
+OUTPUT_PANEL_NAME = "powershell"
+# The output panel's scrollback is trimmed at the front beyond these limits.
+OUTPUT_PANEL_MAX_LINES = 5000
+OUTPUT_PANEL_MAX_CHARS = 1024 * 1024
+# Milliseconds to wait for more output before writing to the panel.
+OUTPUT_PANEL_FLUSH_DELAY = 50
+# Filtering files on disk: files per run of the pipeline, concurrent runs
+# and size above which files are mapped into memory instead of read.
+FILTER_FILES_BATCH_SIZE = 16
+FILTER_FILES_WORKERS = 4
+FILTER_FILES_MMAP_THRESHOLD = 1024 * 1024
+# Syntax check results kept for commands run again.
+PREFLIGHT_CACHE_SIZE = 100
+# Selected text is read with a single call unless that would read this many
+# times more text than is selected.
+SNAPSHOT_MAX_READ_RATIO = 4
 DEBUG = os.path.exists(sublime.packages_path() + "/" + THIS_PACKAGE_DEV_NAME)
 
 
@@ -41,17 +92,58 @@ class CantAccessScriptFileError(Exception):
     pass
 
 
-def regions_to_posh_array(view, rgs):
+# Syntax check results by (runner name, command).
+_preflight_cache = {}
+
+
+def iter_posh_array(texts):
     """
-    Return a PoSh array: 'x', 'y', 'z' ... and escape single quotes like
-    this : 'escaped ''sinqle quoted text'''
+    Yield the pieces of a PoSh array: 'x', 'y', 'z' ... and escape single
+    quotes like this : 'escaped ''sinqle quoted text'''
     """
-    return ",".join("'%s'" % view.substr(r).replace("'", "''") for r in rgs)
+    for i, t in enumerate(texts):
+        yield u"'" if not i else u",'"
+        yield t.replace("'", "''")
+        yield u"'"
 
-def get_outputs():
-    tree = ElementTree()
-    tree.parse(get_path_to_output_sink())
-    return [el.text[:-1] for el in tree.findall("out")]
+def texts_to_posh_array(texts):
+    return u"".join(iter_posh_array(texts))
+
+def regions_to_posh_array(view, rgs):
+    return texts_to_posh_array(view.substr(r) for r in rgs)
+
+def parse_frame(line):
+    """
+    Return the (kind, region index, text) triple encoded in a line of
+    output of the script, or None if the line isn't a frame.
+    """
+    match = FRAME_RE.match(line)
+    if not match:
+        return None
+    kind, index, data = match.groups()
+    text = base64.b64decode(data).decode('utf-8').replace('\r\n', '\n')
+    if kind == "err":
+        return kind, int(index), text.strip()
+    # Drop the newline that out-string appends.
+    return kind, int(index), text[:-1] if text.endswith('\n') else text
+
+def get_outputs(PoShOutput):
+    """
+    Return two dicts mapping region indexes to text: the outputs of the
+    regions that went through the pipeline successfully and the error
+    messages of the regions that failed.
+    """
+    outputs, errors = {}, {}
+    for line in PoShOutput.splitlines():
+        collect_frame(outputs, errors, line)
+    return outputs, errors
+
+def collect_frame(outputs, errors, line):
+    """Add the frame in line, if any, to the dicts of get_outputs()."""
+    frame = parse_frame(line)
+    if frame:
+        kind, i, text = frame
+        (outputs if kind == "out" else errors)[i] = text
 
 def get_this_package_name():
     """
@@ -66,8 +158,48 @@ def get_path_to_posh_script():
 def get_path_to_posh_history_db():
     return sublimepath.rootAtPackagesDir(get_this_package_name(), POSH_HISTORY_DB_NAME)
 
-def get_path_to_output_sink():
-    return sublimepath.rootAtPackagesDir(get_this_package_name(), OUTPUT_SINK_NAME)
+def get_path_to_posh_batch_db():
+    return sublimepath.rootAtPackagesDir(get_this_package_name(), POSH_BATCH_DB_NAME)
+
+def get_path_to_posh_trace():
+    return sublimepath.rootAtPackagesDir(get_this_package_name(), POSH_TRACE_FILE_NAME)
+
+def preflight(userPoShCmd, runner):
+    """
+    Return the (offset, message) of the first syntax error in userPoShCmd,
+    or None, before any region is sent to PowerShell.
+    """
+    key = runner.name, userPoShCmd
+    try:
+        return _preflight_cache[key]
+    except KeyError:
+        pass
+    error, final = runner.parse(userPoShCmd)
+    if not final:
+        # The runner's own parser may tell otherwise next time.
+        return error
+    if len(_preflight_cache) >= PREFLIGHT_CACHE_SIZE:
+        _preflight_cache.clear()
+    _preflight_cache[key] = error
+    return error
+
+def show_syntax_error(window, caption, userPoShCmd, error, on_done):
+    """
+    Ask for userPoShCmd again with the error in the caption and the caret
+    where it was found.
+    """
+    offset, message = error
+    sublime.status_message("PowerShell syntax error: %s" % message)
+    panel = window.show_input_panel("%s %s" % (message, caption), userPoShCmd, on_done, None, None)
+    if panel is not None:
+        panel.sel().clear()
+        panel.sel().add(sublime.Region(offset, offset))
+
+def start_span(userPoShCmd, kind, runner, trace):
+    """Return a poshtrace.Span for the run if tracing, or None."""
+    if not trace:
+        return None
+    return poshtrace.Span(get_path_to_posh_trace(), userPoShCmd, kind, runner.name)
 
 def get_posh_saved_history():
     # If the command history file doesn't exist now, it will be created when
@@ -78,67 +210,569 @@ def get_posh_saved_history():
     except IOError:
         return []
 
-def get_oem_cp():
-    # Windows OEM/Ansi codepage mismatch issue.
-    # We need the OEM cp, because powershell is a console program.
-    codepage = ctypes.windll.kernel32.GetOEMCP()
-    return str(codepage)
+def write_script(f, texts, userPoShCmd):
+    """
+    Write the script that runs userPoShCmd on each of texts to the binary
+    stream f as UTF-8, one piece at a time.
+    """
+    f.write(PoSh_SCRIPT_HEAD.encode('utf-8'))
+    for piece in iter_posh_array(texts):
+        f.write(piece.encode('utf-8'))
+    f.write(PoSh_SCRIPT_MIDDLE.encode('utf-8'))
+    f.write(userPoShCmd.encode('utf-8'))
+    f.write(PoSh_SCRIPT_TAIL.encode('utf-8'))
+
+def build_script(texts, userPoShCmd, path=None):
+    # Written atomically so that a run never picks up a half-written script,
+    # but not synced: it's thrown away after the run anyway.
+    with sublimepath.atomicWrite(path or get_path_to_posh_script(), sync=False) as f:
+        f.write(codecs.BOM_UTF8)
+        write_script(f, texts, userPoShCmd)
+
+def filter_thru_posh(texts, userPoShCmd, runner=None, on_line=None, path=None):
+    """
+    Runs userPoShCmd on each of texts and returns the output and errors
+    of the script. If on_line is given, it's called with each line of
+    output as soon as it arrives instead. The script is written to path,
+    or to the package's script file.
+    """
+    try:
+        build_script(texts, userPoShCmd, path)
+    except IOError:
+        raise CantAccessScriptFileError
+
+    runner = runner or poshrunner.get_runner()
+    return runner.run_script(path or get_path_to_posh_script(), on_line)
 
-def build_script(values, userPoShCmd):
-    with codecs.open(get_path_to_posh_script(), 'w', 'utf_8_sig') as f:
-        f.write( PoSh_SCRIPT_TEMPLATE % (get_path_to_output_sink(), values, userPoShCmd) )
 
-def build_posh_cmd_line():
-    return ["powershell",
-                        "-noprofile",
-                        "-nologo",
-                        "-noninteractive",
-                        # PoSh 2.0 lets you specify an ExecutionPolicy
-                        # from the cmdline, but 1.0 doesn't.
-                        "-executionpolicy", "remotesigned",
-                        "-file", get_path_to_posh_script(), ]
+def run_posh_command(cmd, runner=None):
+    """Runs a command without taking into account Sublime regions for filtering.
+    Output should be output to console.
+    """
+    runner = runner or poshrunner.get_runner()
+    return runner.run_command(cmd)
 
-def filter_thru_posh(values, userPoShCmd):
 
+def read_text_file(path):
+    """
+    Return the contents of a UTF-8 file and whether it started with a BOM.
+    Large files are decoded straight from a memory map.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < FILTER_FILES_MMAP_THRESHOLD:
+            text = f.read().decode('utf-8')
+        else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                text = codecs.utf_8_decode(data, 'strict', True)[0]
+            finally:
+                data.close()
+    if text.startswith(u'\ufeff'):
+        return text[1:], True
+    return text, False
+
+def filter_file_batch(paths, userPoShCmd, runner, base_dir, output_dir, stats, lock):
+    texts, files, errors = [], [], {}
+    outputs, failed = {}, {}
+    for path in paths:
+        try:
+            text, bom = read_text_file(path)
+        except (EnvironmentError, UnicodeDecodeError), e:
+            errors[path] = str(e)
+            continue
+        texts.append(text)
+        files.append((path, bom, u'\r\n' in text, len(text)))
+
+    fd, script = tempfile.mkstemp(suffix=".ps1")
+    os.close(fd)
     try:
-        build_script(values, userPoShCmd)
-    except IOError:
-        raise CantAccessScriptFileError
+        # Collect the frames as they arrive rather than buffering all of
+        # the output and splitting it afterwards.
+        PoShOutput, PoShErrInfo = filter_thru_posh(texts, userPoShCmd, runner,
+                                        functools.partial(collect_frame, outputs, failed),
+                                        path=script)
+    except EnvironmentError, e:
+        PoShErrInfo = str(e)
+    except CantAccessScriptFileError:
+        PoShErrInfo = "Cannot access script file."
+    finally:
+        os.remove(script)
+    del texts
+
+    filtered = chars_in = bytes_out = 0
+    for i, (path, bom, crlf, size) in enumerate(files):
+        text = outputs.get(i)
+        if text is None:
+            errors[path] = PoShErrInfo or failed.get(i) or "No output."
+            continue
+        # Frames come back with LF line endings.
+        if crlf:
+            text = text.replace(u'\n', u'\r\n')
+        data = (codecs.BOM_UTF8 if bom else '') + text.encode('utf-8')
+        dest = path
+        if output_dir:
+            dest = os.path.join(output_dir, os.path.relpath(path, base_dir))
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+        try:
+            sublimepath.replaceFile(dest, data)
+        except EnvironmentError, e:
+            errors[path] = str(e)
+            continue
+        filtered += 1
+        chars_in += size
+        bytes_out += len(data)
+
+    with lock:
+        stats["files"] += filtered
+        stats["chars_in"] += chars_in
+        stats["bytes_out"] += bytes_out
+        stats["errors"].update(errors)
+
+def filter_files(paths, userPoShCmd, runner=None, output_dir=None,
+                 workers=FILTER_FILES_WORKERS, batch_size=FILTER_FILES_BATCH_SIZE):
+    """
+    Filters whole files on disk through userPoShCmd without opening them.
+    Each file is a region; files are sent in batches to up to workers
+    concurrent runs of the pipeline. Results replace the files, or go to
+    output_dir under the files' paths relative to their common directory.
+
+    Returns a dict with the number of files filtered, the characters read
+    and bytes written, the time taken and the errors of the files that
+    couldn't be filtered by path.
+    """
+    runner = runner or poshrunner.get_runner()
+    paths = [os.path.abspath(p) for p in paths]
+    base_dir = os.path.commonprefix([os.path.dirname(p) + os.sep for p in paths])
+    base_dir = base_dir[:base_dir.rfind(os.sep) + 1]
+
+    batches = Queue.Queue()
+    for i in range(0, len(paths), batch_size):
+        batches.put(paths[i:i + batch_size])
+
+    stats = {"files": 0, "chars_in": 0, "bytes_out": 0, "errors": {}}
+    lock = threading.Lock()
+    def work():
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                filter_file_batch(batch, userPoShCmd, runner, base_dir, output_dir,
+                                  stats, lock)
+            except Exception, e:
+                # Don't let the worker die quietly: the batch counts as failed.
+                traceback.print_exc()
+                with lock:
+                    for path in batch:
+                        stats["errors"].setdefault(path, "Unexpected error: %s" % e)
+
+    start = time.time()
+    threads = [threading.Thread(target=work) for i in range(min(workers, batches.qsize()))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats["seconds"] = time.time() - start
+    return stats
+
+def format_throughput(stats):
+    seconds = max(stats["seconds"], 0.001)
+    megabytes = stats["bytes_out"] / 1048576.0
+    return ("Filtered %d files (%.1f MB) in %.2fs: %.1f files/s, %.2f MB/s." %
+                (stats["files"], megabytes, seconds,
+                 stats["files"] / seconds, megabytes / seconds))
+
+
+class OutputPanel(object):
+    """
+    Output panel shared by all commands run in a window. Writes are
+    buffered and flushed together, and the oldest lines are dropped so
+    that the scrollback never grows beyond OUTPUT_PANEL_MAX_LINES lines
+    or OUTPUT_PANEL_MAX_CHARS characters.
+    """
 
-    # Hide the child process window.
-    startupinfo = subprocess.STARTUPINFO()
-    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    _panels = {}
 
-    PoShOutput, PoShErrInfo = subprocess.Popen(build_posh_cmd_line(),
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.PIPE,
-                                            startupinfo=startupinfo).communicate()
+    @classmethod
+    def for_window(cls, window):
+        # There's no event for closed windows; forget their panels here.
+        open_windows = set(w.id() for w in sublime.windows())
+        for window_id in cls._panels.keys():
+            if window_id not in open_windows:
+                del cls._panels[window_id]
+        try:
+            return cls._panels[window.id()]
+        except KeyError:
+            panel = cls._panels[window.id()] = cls(window)
+            return panel
+
+    def __init__(self, window, max_lines=OUTPUT_PANEL_MAX_LINES,
+                                        max_chars=OUTPUT_PANEL_MAX_CHARS):
+        self.window = window
+        self.view = window.get_output_panel(OUTPUT_PANEL_NAME)
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.pending = []
+        self.flush_scheduled = False
+
+    def write(self, text):
+        self.pending.append(text)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            sublime.set_timeout(self.flush, OUTPUT_PANEL_FLUSH_DELAY)
+
+    def flush(self):
+        self.flush_scheduled = False
+        # Anything beyond the last max_chars characters would be trimmed
+        # right away, so don't insert it in the first place.
+        text = "".join(self.pending)[-self.max_chars:]
+        self.pending = []
+        if not text:
+            return
+        append(self.view, text)
+        self.trim()
+        self.window.run_command("show_panel", {"panel": "output." + OUTPUT_PANEL_NAME})
+
+    def trim(self):
+        size = self.view.size()
+        cut = max(0, size - self.max_chars)
+        lines = self.view.rowcol(size)[0] + 1
+        if lines > self.max_lines:
+            cut = max(cut, self.view.text_point(lines - self.max_lines, 0))
+        if not cut:
+            return
+        # Drop whole lines only.
+        if self.view.rowcol(cut)[1] != 0:
+            cut = min(self.view.full_line(cut).end(), size)
+        edit = self.view.begin_edit()
+        self.view.erase(edit, sublime.Region(0, cut))
+        self.view.end_edit(edit)
 
-    return ( PoShOutput.decode(get_oem_cp()),
-             PoShErrInfo.decode(get_oem_cp()), )
 
+class SelectionSnapshot(object):
+    """
+    The selected regions of a view, taken once when a run starts, as
+    parallel arrays of start and end offsets. Regions are located after
+    earlier ones have been replaced by adding up the changes in length
+    in a Fenwick tree, so neither locating nor replacing a region calls
+    back into the view for its selection or walks over the other regions.
+    If a key is given, the view also tracks the regions under it, and
+    they are looked up again only once someone else has edited the view.
+    """
 
-def run_posh_command(cmd):
-    """Runs a command without taking into account Sublime regions for filtering.
-    Output should be output to console.
+    def __init__(self, view, key=None):
+        self.view = view
+        self.key = key
+        regions = list(view.sel())
+        self.reset(regions)
+        if key:
+            view.add_regions(key, regions, "", sublime.HIDDEN)
+        # The view's change count as of the last replacement.
+        self.change_count = view.change_count()
+
+    def reset(self, regions):
+        self.starts = array.array('l', [r.begin() for r in regions])
+        self.ends = array.array('l', [r.end() for r in regions])
+        # Changes in length by region index, plus one.
+        self.deltas = array.array('l', [0]) * (len(regions) + 1)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def texts(self):
+        """Return the text of each region."""
+        if not self.starts:
+            return []
+        first, last = self.starts[0], self.ends[-1]
+        selected = sum(self.ends) - sum(self.starts)
+        if last - first > SNAPSHOT_MAX_READ_RATIO * selected + 65536:
+            # Few regions far apart: don't read everything in between.
+            return [self.view.substr(sublime.Region(s, e))
+                    for s, e in zip(self.starts, self.ends)]
+        text = self.view.substr(sublime.Region(first, last))
+        return [text[s - first:e - first] for s, e in zip(self.starts, self.ends)]
+
+    def sync(self):
+        """Catch up with edits made to the view by anyone else."""
+        change_count = self.view.change_count()
+        if self.key and change_count != self.change_count:
+            self.reset(self.view.get_regions(self.key))
+            self.change_count = change_count
+
+    def shift(self, i):
+        """Return how far region i has moved since the snapshot."""
+        total = 0
+        while i > 0:
+            total += self.deltas[i]
+            i -= i & -i
+        return total
+
+    def region(self, i):
+        """Return where region i is now, as long as it hasn't been replaced."""
+        shift = self.shift(i)
+        return sublime.Region(self.starts[i] + shift, self.ends[i] + shift)
+
+    def replace(self, edit, i, text):
+        self.view.replace(edit, self.region(i), text)
+        self.change_count = self.view.change_count()
+        delta = len(text) - (self.ends[i] - self.starts[i])
+        i += 1
+        while i < len(self.deltas):
+            self.deltas[i] += delta
+            i += i & -i
+
+
+class FilterRun(object):
+    """
+    Filters the selected regions of one or more views through the
+    pipeline in background threads, and replaces each region as soon as
+    its output arrives. The regions all go through a single run of the
+    pipeline, unless batch is true: then they are sent in batches sized
+    by an adaptivebatch.AdaptiveBatcher from the timings of earlier
+    batches and runs of the same command. Each view's selection is
+    snapshotted once with a SelectionSnapshot, which keeps track of the
+    regions while earlier ones are replaced or the view is edited.
+    Outputs that arrive together are applied in one callback, and all
+    replacements in a view make up a single undo step.
+    on_finished is called with the command and whether it succeeded for
+    every region. If a poshtrace.Span is given, the run is measured.
+    Only one run at a time may filter a view.
     """
-    encoded_cmd = cmd
-    posh_cmdline = [
-        "powershell.exe",
-                        "-noprofile",
-                        "-noninteractive",
-                        "-nologo",
-                        "-sta",
-                        "-outputformat", "text",
-                        "-command", encoded_cmd
-    ]
-
-    out, error = subprocess.Popen(posh_cmdline,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE).communicate()
-    
-    return (out.decode(get_oem_cp()),
-            error.decode(get_oem_cp()),)
+
+    # Ids of the views being filtered by a run.
+    busy = set()
+
+    def __init__(self, views, userPoShCmd, runner, on_finished, span=None, batch=False):
+        self.views = views
+        self.userPoShCmd = userPoShCmd
+        self.runner = runner
+        self.batch = batch
+        self.on_finished = on_finished
+        self.span = span
+        self.edits = []
+        self.snapshots = []
+        # Index of each view's first region among the regions of all views.
+        self.offsets = []
+        self.replaced = 0
+        self.errors = {}
+        # Set by the background workers.
+        self.lock = threading.Lock()
+        self.workers = set()
+        self.PoShErrInfo = []
+        self.failure = None
+        # Frames waiting for the main thread, and whether it's been asked
+        # to apply them.
+        self.frames = []
+        self.apply_scheduled = False
+
+    def start(self):
+        """
+        Start the run, or return False without doing anything if another
+        run is still filtering one of the views.
+        """
+        ids = set(view.id() for view in self.views)
+        if ids & FilterRun.busy:
+            return False
+        FilterRun.busy |= ids
+        texts = []
+        for view in self.views:
+            view.erase_regions(FAILED_REGIONS_KEY)
+            snapshot = SelectionSnapshot(view, PENDING_REGIONS_KEY)
+            self.offsets.append(len(texts))
+            texts.extend(snapshot.texts())
+            self.snapshots.append(snapshot)
+            self.edits.append(view.begin_edit())
+        self.texts = texts
+        if self.span:
+            self.span.add(regions=len(texts))
+        self.batcher = adaptivebatch.AdaptiveBatcher(len(texts),
+                            adaptivebatch.command_key(self.runner.name, self.userPoShCmd),
+                            get_path_to_posh_batch_db(),
+                            concurrent=self.runner.concurrent, split=self.batch)
+        self.spawn()
+        return True
+
+    def spawn(self):
+        """Start as many workers as the batcher finds worth running."""
+        with self.lock:
+            for worker in range(self.batcher.workers()):
+                if worker not in self.workers:
+                    self.workers.add(worker)
+                    threading.Thread(target=self.run, args=(worker,)).start()
+
+    def run(self, worker):
+        # Runs in the background: only sublime.set_timeout() is safe here.
+        try:
+            self.run_batches(worker)
+        except EnvironmentError, e:
+            self.stop("Windows error. Possible causes:\n\n" +
+                      "* Is Powershell in your %PATH%?\n" +
+                      "* Use Start-Process to start ST from Powershell.\n\n%s" % e)
+        except CantAccessScriptFileError:
+            self.stop("Cannot access script file.")
+        except Exception, e:
+            # The views' edits must be ended whatever went wrong.
+            traceback.print_exc()
+            self.stop("Unexpected error while running Powershell:\n\n%s" % e)
+        finally:
+            self.worker_done(worker)
+
+    def stop(self, failure):
+        self.failure = failure
+        self.batcher.stop()
+
+    def worker_done(self, worker):
+        """Finish the run on the main thread once the last worker is done."""
+        with self.lock:
+            self.workers.discard(worker)
+            if self.workers:
+                return
+        if self.failure:
+            sublime.set_timeout(functools.partial(self.fail, self.failure), 0)
+            return
+        try:
+            self.batcher.save()
+        except EnvironmentError:
+            pass
+        sublime.set_timeout(functools.partial(self.finish, "".join(self.PoShErrInfo)), 0)
+
+    def run_batches(self, worker):
+        # Worker 0 keeps going until there's nothing left to do; the others
+        # stop as soon as the batcher wants fewer workers.
+        while True:
+            batch = self.batcher.next_batch(worker)
+            if batch is None:
+                return
+            start, count = batch
+            on_line = functools.partial(self.on_line, start)
+            if self.span:
+                trace = self.span.batch(on_line)
+                on_line = trace.on_line
+            # Every batch gets a script of its own: other batches and runs
+            # may be writing theirs at the same time.
+            fd, script = tempfile.mkstemp(suffix=".ps1")
+            os.close(fd)
+            try:
+                began = time.time()
+                PoShOutput, PoShErrInfo = filter_thru_posh(
+                                            self.texts[start:start + count],
+                                            self.userPoShCmd, self.runner, on_line, script)
+                self.batcher.record(batch, time.time() - began)
+                if self.span:
+                    trace.done(os.path.getsize(script))
+            finally:
+                os.remove(script)
+            if PoShErrInfo:
+                # The pipeline itself is broken; other batches would fail too.
+                self.PoShErrInfo.append(PoShErrInfo)
+                self.batcher.stop()
+                return
+            self.spawn()
+
+    def on_line(self, offset, line):
+        """Handle a line of output of the batch starting at region offset."""
+        frame = parse_frame(line)
+        if not frame:
+            return
+        kind, i, text = frame
+        with self.lock:
+            self.frames.append((kind, offset + i, text))
+            if self.apply_scheduled:
+                return
+            self.apply_scheduled = True
+        apply = self.apply
+        if self.span:
+            apply = self.span.timed("apply", apply)
+        sublime.set_timeout(apply, 0)
+
+    def locate(self, i):
+        """Return the index of the view of region i and its index in it."""
+        v = bisect.bisect_right(self.offsets, i) - 1
+        return v, i - self.offsets[v]
+
+    def apply(self):
+        """
+        Apply the frames that have arrived since the last call. The view's
+        tracked regions are only looked up if someone else has edited it
+        since the last call.
+        """
+        with self.lock:
+            frames, self.frames = self.frames, []
+            self.apply_scheduled = False
+        replacements = {}
+        for kind, i, text in frames:
+            if kind == "err":
+                self.errors[i] = text
+                continue
+            v, j = self.locate(i)
+            replacements.setdefault(v, []).append((j, text))
+        for v, outputs in replacements.items():
+            snapshot = self.snapshots[v]
+            snapshot.sync()
+            for j, text in outputs:
+                snapshot.replace(self.edits[v], j, text)
+            self.replaced += len(outputs)
+
+    def end(self):
+        # Frames whose callback hasn't run yet belong in this undo step too.
+        self.apply()
+        pending = []
+        for view, edit in zip(self.views, self.edits):
+            view.end_edit(edit)
+            pending.append(view.get_regions(PENDING_REGIONS_KEY))
+            view.erase_regions(PENDING_REGIONS_KEY)
+        FilterRun.busy -= set(view.id() for view in self.views)
+        return pending
+
+    def fail(self, message):
+        self.end()
+        sublime.error_message(message)
+        self.report(False, "failed")
+
+    def report(self, succeeded, status):
+        if self.span:
+            self.span.end(status)
+        self.on_finished(self.userPoShCmd, succeeded)
+
+    def finish(self, PoShErrInfo):
+        pending = self.end()
+
+        # Inform the user that something went wrong in his PoSh code or
+        # do house-keeping.
+        if PoShErrInfo:
+            print PoShErrInfo
+            sublime.status_message("PowerShell error.")
+            self.views[0].window().run_command("show_panel", {"panel": "console"})
+            self.report(False, "script-error")
+            return
+
+        if not self.errors:
+            self.report(True, "ok")
+            return
+
+        # Leave only the failed regions selected and highlighted so that
+        # the command can be retried on them alone.
+        failed = [[] for view in self.views]
+        for i, msg in sorted(self.errors.items()):
+            v, j = self.locate(i)
+            failed[v].append(pending[v][j])
+            if len(self.views) > 1:
+                print "PowerShell error in region %d of %s:\n%s" % (j,
+                            self.views[v].file_name() or self.views[v].name(), msg)
+            else:
+                print "PowerShell error in region %d:\n%s" % (j, msg)
+        for view, regions in zip(self.views, failed):
+            if not regions:
+                continue
+            view.sel().clear()
+            for r in regions:
+                view.sel().add(r)
+            view.add_regions(FAILED_REGIONS_KEY, regions, "invalid", sublime.DRAW_OUTLINED)
+        sublime.status_message("PowerShell error in %d of %d regions." %
+                                    (len(self.errors), len(self.errors) + self.replaced))
+        self.report(False, "region-errors")
 
 
 class RunPowershell(sublime_plugin.TextCommand):
@@ -149,6 +783,7 @@ class RunPowershell(sublime_plugin.TextCommand):
 
     PoSh_HISTORY_MAX_LENGTH = 50
     PSHistory = get_posh_saved_history()
+    historyWriter = sublimepath.GroupCommit()
     lastFailedCommand = ""
 
     def _add_to_posh_history(self, command):
@@ -164,72 +799,194 @@ class RunPowershell(sublime_plugin.TextCommand):
         # view.window().showQuickPanel('', "runExternalPSCommand", self.PSHistory,
         #                                 sublime.QUICK_PANEL_MONOSPACE_FONT)
 
-    def _parse_intrinsic_commands(self, userPoShCmd, view):
+    def _parse_intrinsic_commands(self, userPoShCmd, view, session=None):
         if userPoShCmd == '!h':
             if self.PSHistory:
                 self._show_posh_history(view)
             else:
                 sublime.status_message("Powershell command history is empty.")
             return True
-        if userPoShCmd == '!mkh':
-            try:
-                with open(get_path_to_posh_history_db(), 'w') as f:
-                    cmds = [(cmd + '\n').encode('utf-8') for cmd in self.PSHistory]
-                    f.writelines(cmds)
-                    sublime.status_message("Powershell command history saved.")
+        if userPoShCmd == '!reset':
+            if not session:
+                sublime.status_message("Not in a Powershell session; nothing to reset.")
                 return True
-            except IOError:
-                sublime.status_message("ERROR: Could not save Powershell command history.")
+            # The host may be busy with another run; don't wait for it here.
+            threading.Thread(target=self._reset_session, args=(session,)).start()
+            return True
+        if userPoShCmd == '!mkh':
+            # Saved in the background; the file is replaced all at once.
+            cmds = [(cmd + '\n').encode('utf-8') for cmd in self.PSHistory]
+            self.historyWriter.write(get_path_to_posh_history_db(), "".join(cmds),
+                                     self._on_history_saved)
+            return True
         else:
             return False
 
-    def run(self, edit, initial_text='', command='', as_filter=True):
+    def _reset_session(self, session):
+        poshrunner.reset_sessions(session)
+        sublime.set_timeout(functools.partial(sublime.status_message,
+                                "Powershell session '%s' reset." % session), 0)
+
+    def _on_history_saved(self, error):
+        # Called from the writer's thread.
+        if error:
+            message = "ERROR: Could not save Powershell command history."
+        else:
+            message = "Powershell command history saved."
+        sublime.set_timeout(functools.partial(sublime.status_message, message), 0)
+
+    def run(self, edit, initial_text='', command='', as_filter=True, runner=None, session=None,
+                                                                trace=False, batch=False):
         if command:
-            self.on_done(self.view, edit, command, as_filter)
+            self.on_done(self.view, edit, command, as_filter, runner, session, trace, batch)
             return
 
         # Open cmd line.
         initialText = initial_text or self.lastFailedCommand
-        inputPanel = self.view.window().show_input_panel("PoSh cmd:", initialText, functools.partial(self.on_done, self.view, edit), None, None)
+        inputPanel = self.view.window().show_input_panel("PoSh cmd:", initialText, functools.partial(self.on_done, self.view, edit, runner=runner, session=session, trace=trace, batch=batch), None, None)
 
-    def on_done(self, view, edit, userPoShCmd, as_filter=True):
+    def on_done(self, view, edit, userPoShCmd, as_filter=True, runner=None, session=None,
+                                                                trace=False, batch=False):
         # Exit if user doesn't actually want to filter anything.
-        if self._parse_intrinsic_commands(userPoShCmd, view): return
+        if self._parse_intrinsic_commands(userPoShCmd, view, session): return
+
+        try:
+            runner = poshrunner.get_runner(runner, session)
+        except poshrunner.UnknownRunnerError, e:
+            sublime.error_message(str(e))
+            return
+
+        error = preflight(userPoShCmd, runner)
+        if error:
+            self.lastFailedCommand = userPoShCmd
+            show_syntax_error(view.window(), "PoSh cmd:", userPoShCmd, error,
+                              functools.partial(self.on_done, view, edit, as_filter=as_filter,
+                                                runner=runner, session=session, trace=trace,
+                                                batch=batch))
+            return
 
         # Run command, don't modify the buffer, output to output panel.
         if not as_filter:
-            self.output_view = self.view.window().new_file()
-            self.output_view.set_scratch(True)
-            self.output_view.set_name("Powershell - Output")
-            out, error = run_posh_command(userPoShCmd)
-            if out or error:
-                if out: append(self.output_view, out)
-                if error: append(self.output_view, error)
+            span = start_span(userPoShCmd, "command", runner, trace)
+            panel = OutputPanel.for_window(self.view.window())
+            out, error = run_posh_command(userPoShCmd, runner)
+            if span:
+                span.add(bytes_in=len(userPoShCmd), bytes_out=len(out) + len(error),
+                         execution=time.time() - span.started)
+                span.end("script-error" if error else "ok")
+            if out: panel.write(out)
+            if error: panel.write(error)
             return
 
-        try:
-            PoShOutput, PoShErrInfo = filter_thru_posh(regions_to_posh_array(view, view.sel()), userPoShCmd)
-        except EnvironmentError, e:
-            sublime.error_message("Windows error. Possible causes:\n\n" +
-                                  "* Is Powershell in your %PATH%?\n" +
-                                  "* Use Start-Process to start ST from Powershell.\n\n%s" % e)
+        if not FilterRun([view], userPoShCmd, runner, self._on_filter_finished,
+                         start_span(userPoShCmd, "filter", runner, trace), batch).start():
+            sublime.status_message("Powershell is still filtering this view.")
+
+    def _on_filter_finished(self, userPoShCmd, succeeded):
+        if succeeded:
+            self.lastFailedCommand = ''
+            self._add_to_posh_history(userPoShCmd)
+        else:
+            self.lastFailedCommand = userPoShCmd
+
+
+class RunPowershellInAllViews(sublime_plugin.WindowCommand):
+    """
+    Filters the selected regions of every view in the window, or only of
+    the views of files, through the same PoSh pipeline in a single run.
+    """
+
+    lastFailedCommand = ""
+
+    def run(self, initial_text='', command='', files=None, runner=None, session=None,
+                                                                trace=False, batch=False):
+        if command:
+            self.on_done(command, files, runner, session, trace, batch)
             return
-        except CantAccessScriptFileError:
-            sublime.error_message("Cannot access script file.")
+
+        # Open cmd line.
+        initialText = initial_text or self.lastFailedCommand
+        self.window.show_input_panel("PoSh cmd (all views):", initialText, functools.partial(self.on_done, files=files, runner=runner, session=session, trace=trace, batch=batch), None, None)
+
+    def on_done(self, userPoShCmd, files=None, runner=None, session=None, trace=False,
+                                                                            batch=False):
+        views = self.window.views()
+        if files is not None:
+            wanted = set(os.path.normcase(os.path.abspath(f)) for f in files)
+            views = [v for v in views if v.file_name() and
+                        os.path.normcase(os.path.abspath(v.file_name())) in wanted]
+        else:
+            # Views with nothing but carets in them weren't meant to be
+            # filtered.
+            views = [v for v in views if [r for r in v.sel() if not r.empty()]]
+        if not views:
+            sublime.status_message("No regions to filter.")
             return
 
-        # Inform the user that something went wrong in his PoSh code or
-        # perform substitutions and do house-keeping.
-        if PoShErrInfo:
-            print PoShErrInfo
-            sublime.status_message("PowerShell error.")
-            self.view.window().run_command("show_panel", {"panel": "console"})
+        try:
+            runner = poshrunner.get_runner(runner, session)
+        except poshrunner.UnknownRunnerError, e:
+            sublime.error_message(str(e))
+            return
+
+        error = preflight(userPoShCmd, runner)
+        if error:
             self.lastFailedCommand = userPoShCmd
+            show_syntax_error(self.window, "PoSh cmd (all views):", userPoShCmd, error,
+                              functools.partial(self.on_done, files=files, runner=runner,
+                                                session=session, trace=trace, batch=batch))
             return
+
+        if not FilterRun(views, userPoShCmd, runner, self._on_filter_finished,
+                         start_span(userPoShCmd, "filter", runner, trace), batch).start():
+            sublime.status_message("Powershell is still filtering some of the views.")
+
+    def _on_filter_finished(self, userPoShCmd, succeeded):
+        self.lastFailedCommand = '' if succeeded else userPoShCmd
+
+
+class RunPowershellOnFiles(sublime_plugin.WindowCommand):
+    """
+    Filters whole files on disk through a PoSh pipeline without opening
+    them. See filter_files().
+    """
+
+    def run(self, files, command='', output_dir=None, runner=None, session=None,
+                                                workers=FILTER_FILES_WORKERS):
+        if command:
+            self.on_done(command, files, output_dir, runner, session, workers)
+            return
+
+        self.window.show_input_panel("PoSh cmd (%d files):" % len(files), '', functools.partial(self.on_done, files=files, output_dir=output_dir, runner=runner, session=session, workers=workers), None, None)
+
+    def on_done(self, userPoShCmd, files, output_dir=None, runner=None, session=None,
+                                                workers=FILTER_FILES_WORKERS):
+        try:
+            runner = poshrunner.get_runner(runner, session)
+        except poshrunner.UnknownRunnerError, e:
+            sublime.error_message(str(e))
+            return
+
+        error = preflight(userPoShCmd, runner)
+        if error:
+            show_syntax_error(self.window, "PoSh cmd (%d files):" % len(files), userPoShCmd, error,
+                              functools.partial(self.on_done, files=files, output_dir=output_dir,
+                                                runner=runner, session=session, workers=workers))
+            return
+
+        sublime.status_message("Filtering %d files..." % len(files))
+        def filter_in_background():
+            stats = filter_files(files, userPoShCmd, runner, output_dir, workers)
+            sublime.set_timeout(functools.partial(self.report, stats), 0)
+        threading.Thread(target=filter_in_background).start()
+
+    def report(self, stats):
+        for path, error in sorted(stats["errors"].items()):
+            print "PowerShell error in %s:\n%s" % (path, error)
+        print format_throughput(stats)
+        if stats["errors"]:
+            sublime.status_message("PowerShell error in %d files. %s" %
+                                    (len(stats["errors"]), format_throughput(stats)))
+            self.window.run_command("show_panel", {"panel": "console"})
         else:
-            self.lastFailedCommand = ''
-            self._add_to_posh_history(userPoShCmd)
-            # Cannot do zip(regs, outputs) because view.sel() maintains
-            # regions up-to-date if any of them changes.
-            for i, txt in enumerate(get_outputs()):
-                view.replace(edit, view.sel()[i], txt)
+            sublime.status_message(format_throughput(stats))
@@ -0,0 +1,510 @@
+# Backends that run PoSh scripts and commands for executepscommand.
+#
+# All runners return (output, error) unicode pairs. Besides the real
+# interpreters, FakeRunner runs the filter pipeline in process so that it
+# can be tested and profiled where PowerShell isn't installed.
+from __future__ import with_statement
+import os
+import re
+import time
+import codecs
+import ctypes
+import base64
+import subprocess
+import threading
+
+import poshsyntax
+
+
+class UnknownRunnerError(Exception):
+    pass
+
+
+# Run by HostRunner's interpreter. Reads requests from stdin, one per line:
+#   <run|reset|parse> TAB <session name or nothing> TAB <token> TAB <base64-encoded UTF-8 script>
+# and answers each of them with whatever the script writes to stdout plus
+# its output, followed by a line with the request's token and the errors:
+#   done <token> <base64-encoded UTF-8 errors>
+# The token is new for every request, so that no output can pass for the
+# end of it.
+# Scripts run in a fresh runspace unless a session is named, in which case
+# they share the runspace kept for it until it's reset. Scripts to parse
+# aren't run; their syntax errors are returned one per line as:
+#   <offset> TAB <message>
+HOST_SCRIPT = u"""
+$runspaces = @{}
+while ($true) {
+    $request = [Console]::In.ReadLine()
+    if ($request -eq $null) { break }
+    $verb, $session, $token, $data = $request.Split("`t")
+    $errors = ""
+    if ($verb -eq "reset") {
+        foreach ($name in @($runspaces.Keys)) {
+            if (-not $session -or $name -eq $session) {
+                $runspaces[$name].Close()
+                $runspaces.Remove($name)
+            }
+        }
+    }
+    elseif ($verb -eq "parse") {
+        $script = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($data))
+        $parseErrors = $null
+        if ("System.Management.Automation.Language.Parser" -as [type]) {
+            $tokens = $null
+            [void][System.Management.Automation.Language.Parser]::ParseInput($script,
+                                                        [ref]$tokens, [ref]$parseErrors)
+            $errors = [string]::join("`n", @($parseErrors | foreach-object {
+                                                "$($_.Extent.StartOffset)`t$($_.Message)" }))
+        }
+        else {
+            # PowerShell 2 has only got the tokenizer, which misses errors
+            # such as a pipe with nothing after it.
+            [void][System.Management.Automation.PSParser]::Tokenize($script, [ref]$parseErrors)
+            $errors = [string]::join("`n", @($parseErrors | foreach-object {
+                                                "$($_.Token.Start)`t$($_.Message)" }))
+        }
+    }
+    else {
+        $ps = [powershell]::Create()
+        if ($session) {
+            if (-not $runspaces.ContainsKey($session)) {
+                $runspaces[$session] = [runspacefactory]::CreateRunspace()
+                $runspaces[$session].Open()
+            }
+            $ps.Runspace = $runspaces[$session]
+        }
+        try {
+            $script = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($data))
+            $ps.AddScript($script).AddCommand("out-string") | out-null
+            [Console]::Out.Write([string]::join("", $ps.Invoke()))
+            $errors = $ps.Streams.Error | out-string
+        }
+        catch {
+            $errors = $_ | out-string
+        }
+        $ps.Dispose()
+    }
+    [Console]::Out.WriteLine("done $token " + [Convert]::ToBase64String([Text.Encoding]::UTF8.GetBytes($errors)))
+    [Console]::Out.Flush()
+}
+"""
+
+
+def find_executable(name):
+    exts = [""]
+    if os.name == 'nt':
+        exts.append(".exe")
+    for dir in os.environ.get("PATH", "").split(os.pathsep):
+        for ext in exts:
+            path = os.path.join(dir, name + ext)
+            if os.path.isfile(path):
+                return path
+    return None
+
+def get_oem_cp():
+    # Windows OEM/Ansi codepage mismatch issue.
+    # We need the OEM cp, because powershell is a console program.
+    codepage = ctypes.windll.kernel32.GetOEMCP()
+    return str(codepage)
+
+
+class Runner(object):
+    """Interface for the PoSh backends."""
+
+    name = None
+    # Whether scripts may be run from several threads at once.
+    concurrent = True
+
+    def is_available(self):
+        return True
+
+    def run_script(self, path, on_line=None):
+        """
+        Runs the script file at path. If on_line is given, it's called
+        with each line of output as soon as it's available, and only the
+        errors are returned.
+        """
+        raise NotImplementedError
+
+    def run_command(self, cmd):
+        """Runs a single command line."""
+        raise NotImplementedError
+
+    def check_syntax(self, cmd):
+        """
+        Return the (offset, message) of the first syntax error in cmd, or
+        None. It must be fast: it's called before every run.
+        """
+        return self.parse(cmd)[0]
+
+    def parse(self, cmd):
+        """
+        Return what check_syntax() would, and whether that's final: false
+        if a local check stood in for a parser that may know better.
+        """
+        return poshsyntax.find_syntax_error(cmd), True
+
+
+class ProcessRunner(Runner):
+    """Starts a new interpreter process for every script or command."""
+
+    executable = None
+
+    def is_available(self):
+        return find_executable(self.executable) is not None
+
+    def common_args(self):
+        args = [self.executable, "-noprofile", "-nologo", "-noninteractive"]
+        if os.name == 'nt':
+            # PoSh 2.0 lets you specify an ExecutionPolicy
+            # from the cmdline, but 1.0 doesn't.
+            args.extend(["-executionpolicy", "remotesigned"])
+        return args
+
+    def script_cmd_line(self, path):
+        return self.common_args() + ["-file", path]
+
+    def command_cmd_line(self, cmd):
+        return self.common_args() + ["-outputformat", "text", "-command", cmd]
+
+    def host_cmd_line(self):
+        return self.common_args() + ["-encodedcommand",
+                                     base64.b64encode(HOST_SCRIPT.encode('utf-16-le'))]
+
+    def decode(self, data):
+        if os.name == 'nt':
+            return data.decode(get_oem_cp())
+        return data.decode('utf-8')
+
+    def popen(self, args, stdin=None):
+        startupinfo = None
+        if os.name == 'nt':
+            # Hide the child process window.
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+        return subprocess.Popen(args,
+                                stdin=stdin,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                startupinfo=startupinfo)
+
+    def communicate(self, args):
+        out, error = self.popen(args).communicate()
+        return self.decode(out), self.decode(error)
+
+    def stream(self, args, on_line):
+        proc = self.popen(args)
+        # Drain stderr meanwhile so that the child never blocks on it.
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+        reader.start()
+        for line in iter(proc.stdout.readline, ''):
+            on_line(self.decode(line))
+        proc.wait()
+        reader.join()
+        return u"", self.decode(errors[0])
+
+    def run_script(self, path, on_line=None):
+        if on_line:
+            return self.stream(self.script_cmd_line(path), on_line)
+        return self.communicate(self.script_cmd_line(path))
+
+    def run_command(self, cmd):
+        return self.communicate(self.command_cmd_line(cmd))
+
+
+class WindowsPowershellRunner(ProcessRunner):
+    name = "powershell"
+    executable = "powershell"
+
+    def command_cmd_line(self, cmd):
+        return self.common_args() + ["-sta", "-outputformat", "text",
+                                     "-command", cmd]
+
+
+class PwshRunner(ProcessRunner):
+    """PowerShell Core, available on Linux and OS X too."""
+
+    name = "pwsh"
+    executable = "pwsh"
+
+
+class HostProcess(object):
+    """
+    An interpreter running HOST_SCRIPT. It's started on the first request
+    and restarted if it dies; requests are served one at a time. Sessions
+    die with the host: the next request in one of them fails to say so.
+    """
+
+    # Output that doesn't end with a newline runs into the done line.
+    DONE_RE = re.compile(r"^(.*)done ([0-9a-f]+) ([A-Za-z0-9+/=]*)\s*$", re.S)
+    # Scripts read from files are encoded this many bytes at a time. A
+    # multiple of 3, so that the pieces add up to the encoding of the
+    # whole script.
+    CHUNK_SIZE = 3 * 16384
+
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.proc = None
+        self.errors = []
+        self.lock = threading.Lock()
+        # Sessions that have state in the host, and those that had it in a
+        # host that has since died.
+        self.sessions = set()
+        self.lost = set()
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = self.interpreter.popen(self.interpreter.host_cmd_line(),
+                                           stdin=subprocess.PIPE)
+        self.errors = []
+        # Drain stderr so that the host never blocks on it.
+        threading.Thread(target=lambda proc=self.proc, errors=self.errors:
+                            errors.extend(iter(proc.stderr.readline, ''))).start()
+
+    def request(self, verb, session=None, script=u"", on_line=None, wait=True):
+        """
+        Sends a request and returns its (output, errors). The script may
+        be a string or a binary file of UTF-8, which is sent a piece at a
+        time. If wait is false and another request is being served,
+        returns None right away.
+        """
+        if not self.lock.acquire(wait):
+            return None
+        try:
+            return self._request(verb, session, script, on_line)
+        finally:
+            self.lock.release()
+
+    def _request(self, verb, session, script, on_line):
+        if verb == "reset":
+            for sessions in self.sessions, self.lost:
+                if session:
+                    sessions.discard(session)
+                else:
+                    sessions.clear()
+            if not self.is_running():
+                return u"", u""
+        if not self.is_running():
+            self.lost |= self.sessions
+            self.sessions = set()
+            self.start()
+        if session in self.lost:
+            self.lost.discard(session)
+            return (u"", u"The PowerShell host had exited: session '%s' was lost with it "
+                         u"and starts afresh on the next run.\n" % session)
+        if verb == "run" and session:
+            self.sessions.add(session)
+        if isinstance(script, unicode):
+            script = script.encode('utf-8')
+        token = os.urandom(16).encode('hex')
+        self.proc.stdin.write("%s\t%s\t%s\t" % (verb, session or "", token))
+        if isinstance(script, str):
+            self.proc.stdin.write(base64.b64encode(script))
+        else:
+            for chunk in iter(lambda: script.read(self.CHUNK_SIZE), ''):
+                self.proc.stdin.write(base64.b64encode(chunk))
+        self.proc.stdin.write("\n")
+        self.proc.stdin.flush()
+
+        out = []
+        for line in iter(self.proc.stdout.readline, ''):
+            match = self.DONE_RE.match(line)
+            done = match and match.group(2) == token
+            if done:
+                line = match.group(1)
+            if line:
+                line = self.interpreter.decode(line)
+                if on_line:
+                    on_line(line)
+                else:
+                    out.append(line)
+            if done:
+                return u"".join(out), base64.b64decode(match.group(3)).decode('utf-8')
+
+        self.proc.wait()
+        error = (self.interpreter.decode("".join(self.errors)) or
+                    u"The PowerShell host exited unexpectedly.\n")
+        if session in self.sessions:
+            # Already reported; the next run starts the session afresh.
+            self.sessions.discard(session)
+            error += u"Session '%s' was lost with it.\n" % session
+        return u"".join(out), error
+
+
+class HostRunner(Runner):
+    """
+    Runs everything in a PowerShell host process that is kept alive
+    between runs, so that only the first one pays for starting it. If a
+    session is named, scripts share a runspace: variables, functions and
+    modules loaded by one run are there for the next until the session
+    is reset.
+    """
+
+    name = "host"
+    # The host serves one request at a time.
+    concurrent = False
+
+    def __init__(self, interpreter=None, session=None):
+        self.interpreter = interpreter or RUNNERS[DEFAULT_RUNNER]()
+        self.session = session
+
+    def is_available(self):
+        return self.interpreter.is_available()
+
+    def host(self):
+        try:
+            return _hosts[self.interpreter.name]
+        except KeyError:
+            host = _hosts[self.interpreter.name] = HostProcess(self.interpreter)
+            return host
+
+    def run_script(self, path, on_line=None):
+        # Pass the UTF-8 bytes on as they are instead of decoding them, and
+        # without holding the whole script in memory.
+        with open(path, 'rb') as f:
+            if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+                f.seek(0)
+            return self.host().request("run", self.session, f, on_line)
+
+    def run_command(self, cmd):
+        return self.host().request("run", self.session, cmd)
+
+    def parse(self, cmd):
+        # Starting the host just for this would take longer than the run
+        # it's meant to spare.
+        if not self.host().is_running():
+            return self.parse_locally(cmd)
+        # This runs on the UI thread: don't wait for a run in progress.
+        result = self.host().request("parse", script=cmd, wait=False)
+        if result is None:
+            return self.parse_locally(cmd)
+        out, errors = result
+        for line in errors.splitlines():
+            offset, sep, message = line.partition("\t")
+            if sep and offset.isdigit():
+                return (int(offset), message), True
+        if errors.strip():
+            # Not parser errors: the host is in trouble.
+            return self.parse_locally(cmd)
+        return None, True
+
+    def parse_locally(self, cmd):
+        return Runner.parse(self, cmd)[0], False
+
+
+class FakeRunner(Runner):
+    """
+    Stand-in for PowerShell that never leaves the Python process.
+    Scripts generated from executepscommand's template are interpreted
+    by calling filters[userPoShCmd] on each region's text; commands are
+    looked up in commands. Anything else fails like PowerShell would
+    with an unknown command.
+    """
+
+    name = "fake"
+
+    VALUES_RE = re.compile(r"^\$script:regionTexts = ((?:'(?:[^']|'')*',?)*)$", re.M)
+    VALUE_RE = re.compile(r"'((?:[^']|'')*)'")
+    COMMAND_RE = re.compile(r'^\s*(.*) \| out-string \| writeFrame "out"', re.M)
+
+    def __init__(self, filters=None, commands=None):
+        self.filters = filters or {}
+        self.commands = commands or {}
+
+    def frame(self, kind, index, text):
+        return u"%s %d %s\n" % (kind, index, base64.b64encode(text.encode('utf-8')))
+
+    def run_script(self, path, on_line=None):
+        with codecs.open(path, 'r', 'utf_8_sig') as f:
+            script = f.read()
+
+        values = [v.replace("''", "'") for v in
+                    self.VALUE_RE.findall(self.VALUES_RE.search(script).group(1))]
+        cmd = self.COMMAND_RE.search(script).group(1)
+        if cmd not in self.filters:
+            return u"", u"The term '%s' is not recognized.\n" % cmd
+
+        lines = []
+        for i, value in enumerate(values):
+            try:
+                line = self.frame("out", i, self.filters[cmd](value) + u"\n")
+            except Exception, e:
+                line = self.frame("err", i, unicode(e))
+            if on_line:
+                on_line(line)
+            else:
+                lines.append(line)
+        return u"".join(lines), u""
+
+    def run_command(self, cmd):
+        try:
+            return self.commands[cmd], u""
+        except KeyError:
+            return u"", u"The term '%s' is not recognized.\n" % cmd
+
+
+RUNNERS = dict((cls.name, cls) for cls in (WindowsPowershellRunner,
+                                           PwshRunner,
+                                           FakeRunner))
+DEFAULT_RUNNER = "powershell" if os.name == 'nt' else "pwsh"
+
+_fastest_runner_name = None
+# Host processes by interpreter name.
+_hosts = {}
+
+
+def get_fastest_runner_name(names=("powershell", "pwsh")):
+    """
+    Return the name of the available interpreter that starts the fastest.
+    Each of them is timed once per session.
+    """
+    global _fastest_runner_name
+    if _fastest_runner_name is None:
+        timings = []
+        for name in names:
+            runner = RUNNERS[name]()
+            if not runner.is_available():
+                continue
+            start = time.time()
+            runner.run_command("exit")
+            timings.append((time.time() - start, name))
+        if not timings:
+            raise UnknownRunnerError("No PowerShell interpreter found.")
+        _fastest_runner_name = min(timings)[1]
+    return _fastest_runner_name
+
+
+def reset_sessions(session=None):
+    """Drops the runspace of the named session, or of all sessions."""
+    for host in _hosts.values():
+        host.request("reset", session)
+
+
+def get_runner(name=None, session=None):
+    """
+    Return a runner by name. None means the platform's default and
+    'fastest' the interpreter that starts the fastest on this machine.
+    Runner instances are returned as they are. Naming a session implies
+    running in a host process.
+    """
+    if isinstance(name, Runner):
+        return name
+    if name == "host":
+        return HostRunner(session=session)
+    if name is None:
+        name = DEFAULT_RUNNER
+    elif name == "fastest":
+        name = get_fastest_runner_name()
+    try:
+        runner = RUNNERS[name]()
+    except KeyError:
+        raise UnknownRunnerError("Unknown PowerShell runner: %s" % name)
+    if session is None:
+        return runner
+    if not isinstance(runner, ProcessRunner):
+        raise UnknownRunnerError("The %s runner can't keep sessions." % name)
+    return HostRunner(runner, session)
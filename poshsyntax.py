@@ -0,0 +1,119 @@
+# A quick check of PoSh pipelines for the mistakes that are easiest to
+# make when typing them into the input panel: unterminated strings and
+# comments, unbalanced brackets and empty pipe elements.
+#
+# It's no parser: anything it lets through may still fail in PowerShell,
+# but what it rejects would never run. It's used when no PowerShell host
+# is at hand to parse the pipeline for real.
+
+BRACKETS = {"(": ")", "{": "}", "[": "]"}
+# Characters after which # starts a comment rather than being part of a word.
+COMMENT_PRECEDERS = " \t\r\n;|(){}"
+# A pipe right after these has nothing on its left.
+PIPE_PRECEDERS = (None, "|", "(", "{", ";")
+
+
+def missing_terminator(terminator):
+    return "The string is missing the terminator: %s." % terminator
+
+def find_string_end(cmd, i, quote):
+    """Return the index of the quote closing the string opened at i, or -1."""
+    i += 1
+    while i < len(cmd):
+        c = cmd[i]
+        if c == "`" and quote == '"':
+            i += 2
+            continue
+        if c == quote:
+            # Doubled quotes are escaped quotes.
+            if cmd[i + 1:i + 2] != quote:
+                return i
+            i += 1
+        i += 1
+    return -1
+
+def find_syntax_error(cmd):
+    """
+    Return the (offset, message) of the first syntax error found in cmd,
+    or None.
+    """
+    # Open brackets and double-quoted strings: (closing character, offset).
+    # Subexpressions $(...) inside strings nest like any other bracket.
+    stack = []
+    last = None
+    last_offset = 0
+    i, n = 0, len(cmd)
+    while i < n:
+        c = cmd[i]
+        if stack and stack[-1][0] == '"':
+            if c == "`":
+                i += 2
+                continue
+            if c == '"':
+                if cmd[i + 1:i + 2] == '"':
+                    i += 2
+                    continue
+                stack.pop()
+                last, last_offset = c, i
+            elif cmd.startswith("$(", i):
+                stack.append((")", i + 1))
+                i += 2
+                continue
+            i += 1
+            continue
+
+        if c in " \t\r\n":
+            i += 1
+            continue
+        if c == "`":
+            i += 2
+            continue
+        if cmd.startswith("@'\n", i) or cmd.startswith("@'\r\n", i) or \
+           cmd.startswith('@"\n', i) or cmd.startswith('@"\r\n', i):
+            end = cmd.find("\n" + cmd[i + 1] + "@", i)
+            if end == -1:
+                return i, missing_terminator(cmd[i + 1] + "@")
+            i = end + 3
+            last = "@"
+            continue
+        if cmd.startswith("<#", i):
+            end = cmd.find("#>", i + 2)
+            if end == -1:
+                return i, missing_terminator("#>")
+            i = end + 2
+            continue
+        if c == "#" and (i == 0 or cmd[i - 1] in COMMENT_PRECEDERS):
+            end = cmd.find("\n", i)
+            i = n if end == -1 else end + 1
+            continue
+
+        if c == "'":
+            end = find_string_end(cmd, i, "'")
+            if end == -1:
+                return i, missing_terminator("'")
+            i = end
+        elif c == '"':
+            stack.append(('"', i))
+        elif c in BRACKETS:
+            stack.append((BRACKETS[c], i))
+        elif c in ")}]":
+            if not stack or stack[-1][0] != c:
+                return i, "Unexpected token '%s' in expression or statement." % c
+            stack.pop()
+        elif c == "|":
+            if last in PIPE_PRECEDERS:
+                return i, "An empty pipe element is not allowed."
+            if cmd.startswith("||", i):
+                # A pipeline chain operator; it needs a pipeline after it too.
+                i += 1
+        last, last_offset = c, i
+        i += 1
+
+    if stack:
+        closer, offset = stack[-1]
+        if closer == '"':
+            return offset, missing_terminator('"')
+        return offset, "Missing closing '%s'." % closer
+    if last == "|":
+        return last_offset, "An empty pipe element is not allowed."
+    return None
@@ -0,0 +1,178 @@
+# Optional trace spans for PowerShell runs, appended as JSON lines to a
+# file that is rotated when it grows too large. Run this module to get a
+# summary of the traced runs per command:
+#
+#   python poshtrace.py path/to/pstrace.jsonl
+#
+# When tracing is off, no span is created at all and callers skip every
+# measurement behind an "if span:" check.
+from __future__ import with_statement
+import os
+import sys
+import math
+import time
+import json
+import hashlib
+import logging
+import logging.handlers
+import threading
+
+TRACE_MAX_BYTES = 1024 * 1024
+TRACE_BACKUPS = 3
+# Durations, in seconds, that are summarized by the report.
+PHASES = ("spawn", "execution", "parse", "apply", "total")
+PERCENTILES = (50, 90, 99)
+
+# Loggers by trace file path.
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def command_hash(cmd):
+    return hashlib.sha1(cmd.encode('utf-8')).hexdigest()[:12]
+
+def get_logger(path):
+    with _loggers_lock:
+        try:
+            return _loggers[path]
+        except KeyError:
+            logger = logging.getLogger("PowershellUtils.trace.%s" % path)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(path,
+                                                maxBytes=TRACE_MAX_BYTES,
+                                                backupCount=TRACE_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _loggers[path] = logger
+            return logger
+
+
+class BatchTrace(object):
+    """
+    Times one run of a script: spawn is the time until its first line of
+    output arrives, execution the time from then on, and parse the time
+    spent handling the lines.
+    """
+
+    def __init__(self, span, on_line):
+        self.span = span
+        self.wrapped = on_line
+        self.started = time.time()
+        self.first = None
+
+    def on_line(self, line):
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.wrapped(line)
+        self.span.add(bytes_out=len(line), parse=time.time() - now)
+
+    def done(self, bytes_in=0):
+        now = time.time()
+        first = self.first or now
+        self.span.add(batches=1, bytes_in=bytes_in,
+                      spawn=first - self.started, execution=now - first)
+
+
+class Span(object):
+    """The measurements of a single run of a command, from any thread."""
+
+    def __init__(self, path, userPoShCmd, kind, runner):
+        self.path = path
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.fields = {"command": command_hash(userPoShCmd), "kind": kind,
+                       "runner": runner, "regions": 0, "batches": 0,
+                       "bytes_in": 0, "bytes_out": 0,
+                       "spawn": 0.0, "execution": 0.0, "parse": 0.0, "apply": 0.0}
+
+    def add(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.fields[name] += amount
+
+    def batch(self, on_line):
+        return BatchTrace(self, on_line)
+
+    def timed(self, name, func):
+        """Return func wrapped so that its duration is added to name."""
+        def timed_func(*args):
+            began = time.time()
+            try:
+                return func(*args)
+            finally:
+                self.add(**{name: time.time() - began})
+        return timed_func
+
+    def end(self, status):
+        with self.lock:
+            self.fields.update(started=self.started, status=status,
+                               total=time.time() - self.started)
+            record = json.dumps(self.fields, sort_keys=True)
+        try:
+            get_logger(self.path).info(record)
+        except EnvironmentError:
+            pass
+
+
+def read_spans(path):
+    """Yield the spans in path and in its rotated backups, oldest first."""
+    for i in range(TRACE_BACKUPS, -1, -1):
+        name = "%s.%d" % (path, i) if i else path
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+def summarize(spans):
+    """
+    Return a dict mapping command hashes to their number of runs, runs
+    by status and the percentiles of each phase's duration.
+    """
+    by_command = {}
+    for span in spans:
+        by_command.setdefault(span["command"], []).append(span)
+    summary = {}
+    for command, runs in by_command.items():
+        statuses = {}
+        for run in runs:
+            statuses[run["status"]] = statuses.get(run["status"], 0) + 1
+        phases = {}
+        for phase in PHASES:
+            values = sorted(run.get(phase, 0.0) for run in runs)
+            phases[phase] = dict((p, percentile(values, p)) for p in PERCENTILES)
+        summary[command] = {"runs": len(runs), "statuses": statuses,
+                            "regions": sum(run["regions"] for run in runs),
+                            "phases": phases}
+    return summary
+
+def format_summary(summary):
+    lines = []
+    # Slowest commands first.
+    for command, info in sorted(summary.items(),
+                                key=lambda item: -item[1]["phases"]["total"][90]):
+        statuses = ", ".join("%s: %d" % s for s in sorted(info["statuses"].items()))
+        lines.append("%s  %d runs, %d regions, %s" % (command, info["runs"],
+                                                      info["regions"], statuses))
+        for phase in PHASES:
+            durations = ["p%d %8.1fms" % (p, info["phases"][phase][p] * 1000)
+                         for p in PERCENTILES]
+            lines.append("  %-10s %s" % (phase, "  ".join(durations)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage: python poshtrace.py path/to/pstrace.jsonl"
+        sys.exit(2)
+    print format_summary(summarize(read_spans(sys.argv[1])))
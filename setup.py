@@ -12,68 +12,543 @@ from distutils.core import setup
 from distutils.text_file import TextFile
 from distutils.filelist import FileList
 from distutils.errors import *
-from distutils.spawn import spawn
 from distutils.dir_util import mkpath
-import subprocess
+import hashlib
+import json
+import re
+import stat
+import struct
+import time
+import traceback
+import unittest
+import zlib
+from StringIO import StringIO
+
+
+# Compressed entries of previous builds are kept here so that only the
+# files that changed since the last build need to be compressed again.
+SPA_CACHE_DIR = os.path.join("build", "spa")
+SPA_CACHE_MANIFEST = "manifest.json"
+SPA_CACHE_FILELIST = "filelist.json"
+
+ZIP_LOCAL_HEADER = "<4s5H3L2H"
+ZIP_CENTRAL_HEADER = "<4s6H3L5H2L"
+ZIP_END_RECORD = "<4s4H2LH"
+ZIP_VERSION = 20
+ZIP_DEFLATED = 8
+ZIP_COMPRESS_LEVEL = 6
+# MS-DOS (date, time) for 1980-01-01 00:00, the earliest zip timestamp.
+ZIP_EPOCH = ((0 << 9) | (1 << 5) | 1, 0)
+# Permissions of every entry in deterministic archives.
+ZIP_DETERMINISTIC_MODE = stat.S_IFREG | 0644
+
+
+def compress_data (data):
+    """Compress 'data' into a raw deflate stream, as stored in zip
+    archives.  Returns a (md5 hex digest, CRC-32, size, compressed data)
+    tuple.
+    """
+    compressor = zlib.compressobj(ZIP_COMPRESS_LEVEL,
+                                  zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (hashlib.md5(data).hexdigest(),
+            zlib.crc32(data) & 0xffffffff,
+            len(data),
+            compressor.compress(data) + compressor.flush())
+
+def read_file (path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
 
+def compress_file (path):
+    """Like 'compress_data()', but for the contents of the file 'path'.
+    Must stay at module level so that worker processes can run it.
+    """
+    return compress_data(read_file(path))
 
-def make_zipfile (base_name, base_dir, verbose=0, dry_run=0):
-    """Create a zip file from all the files under 'base_dir'.  The output
-    zip file will be named 'base_dir' + ".zip".  Uses either the "zipfile"
-    Python module (if available) or the InfoZIP "zip" utility (if installed
-    and found on the default search path).  If neither tool is available,
-    raises DistutilsExecError.  Returns the name of the output zip file.
+def hash_file (path):
+    """Return the md5 hex digest of the contents of the file 'path'.
+    Must stay at module level so that worker processes can run it.
     """
+    return hashlib.md5(read_file(path)).hexdigest()
+
+def parallel_map (func, items, processes=None, chunksize=None,
+                  maxtasksperchild=None):
+    """Map 'func' over 'items' on a pool of worker processes, falling
+    back to the builtin map() if there is not enough work to make it
+    worthwhile or the multiprocessing module is not available.
+    'processes' defaults to one per CPU. With 'maxtasksperchild', workers
+    are replaced by fresh processes after that many chunks, so that no
+    state is left over from earlier ones.
+    """
+    if len(items) < 2 or processes == 1:
+        return map(func, items)
     try:
-        import zipfile
-    except ImportError:
-        zipfile = None
+        import multiprocessing
+        if multiprocessing.current_process().daemon:
+            # A pool's workers can't start workers of their own.
+            return map(func, items)
+        if maxtasksperchild:
+            pool = multiprocessing.Pool(processes,
+                                        maxtasksperchild=maxtasksperchild)
+        else:
+            pool = multiprocessing.Pool(processes)
+    except (ImportError, OSError):
+        return map(func, items)
 
+    try:
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+def load_package_cache (cache_dir):
+    """Return the cache manifest in 'cache_dir', a dict mapping file
+    names to [mtime, size, md5, crc] lists, or an empty dict if there is
+    no usable cache.
+    """
+    try:
+        f = open(os.path.join(cache_dir, SPA_CACHE_MANIFEST))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def save_package_cache (cache_dir, cache):
+    """Write 'cache' to the manifest in 'cache_dir' and delete the
+    compressed entries that it no longer refers to.
+    """
+    f = open(os.path.join(cache_dir, SPA_CACHE_MANIFEST), 'w')
+    try:
+        json.dump(cache, f)
+    finally:
+        f.close()
+
+    wanted = set(entry[2] + ".z" for entry in cache.values())
+    for name in os.listdir(cache_dir):
+        if name.endswith(".z") and name not in wanted:
+            os.remove(os.path.join(cache_dir, name))
+
+def dos_date_time (mtime):
+    """Return the (date, time) MS-DOS pair that zip headers use for
+    'mtime'.
+    """
+    t = time.localtime(mtime)
+    if t[0] < 1980:
+        return ZIP_EPOCH
+    return (((t[0] - 1980) << 9) | (t[1] << 5) | t[2],
+            (t[3] << 11) | (t[4] << 5) | (t[5] // 2))
+
+def write_zipfile (zip_filename, entries):
+    """Write the zip file 'zip_filename' from 'entries', a sequence of
+    (arcname, mtime, mode, crc, size, data) tuples where 'data' is the
+    entry's contents already compressed by 'compress_data()'.  Entries
+    whose 'mtime' is None get the earliest timestamp zip files support.
+    """
+    f = open(zip_filename, 'wb')
+    try:
+        central_dir = []
+        for arcname, mtime, mode, crc, size, data in entries:
+            name = arcname.replace(os.sep, '/')
+            if mtime is None:
+                date, time_ = ZIP_EPOCH
+            else:
+                date, time_ = dos_date_time(mtime)
+            offset = f.tell()
+            f.write(struct.pack(ZIP_LOCAL_HEADER, 'PK\x03\x04',
+                                ZIP_VERSION, 0, ZIP_DEFLATED, time_, date,
+                                crc, len(data), size, len(name), 0))
+            f.write(name)
+            f.write(data)
+            # Made by: unix (3), so that 'mode' is honored.
+            central_dir.append(struct.pack(ZIP_CENTRAL_HEADER, 'PK\x01\x02',
+                                (3 << 8) | ZIP_VERSION, ZIP_VERSION, 0,
+                                ZIP_DEFLATED, time_, date, crc, len(data),
+                                size, len(name), 0, 0, 0, 0,
+                                (mode & 0xffff) << 16, offset) + name)
+
+        start = f.tell()
+        f.write(''.join(central_dir))
+        f.write(struct.pack(ZIP_END_RECORD, 'PK\x05\x06', 0, 0,
+                            len(central_dir), len(central_dir),
+                            f.tell() - start, start, 0))
+    finally:
+        f.close()
+
+def content_hash (entries):
+    """Return a hex digest identifying the names and contents of
+    'entries', a sequence of (arcname, md5 hex digest) pairs, in order,
+    and the settings that deterministic archives are written with.
+    """
+    digest = hashlib.sha256()
+    digest.update("version %d level %d date %d time %d mode %o\n" %
+                  ((ZIP_VERSION, ZIP_COMPRESS_LEVEL) + ZIP_EPOCH +
+                   (ZIP_DETERMINISTIC_MODE,)))
+    for arcname, md5 in entries:
+        digest.update("%s\0%s\n" % (arcname, md5))
+    return digest.hexdigest()
+
+def make_sublime_package (base_name, files, extra_files=(),
+                          cache_dir=SPA_CACHE_DIR, deterministic=0,
+                          verbose=0, dry_run=0):
+    """Create a .sublime-package archive named 'base_name' +
+    ".sublime-package" straight from 'files' (a list of paths relative to
+    the current directory) plus 'extra_files', a sequence of (arcname,
+    contents) pairs generated on the fly.  Compressed entries are cached
+    in 'cache_dir' and reused for the files whose mtime and size, or
+    else contents, haven't changed since the last build; the rest are
+    compressed in parallel.
+
+    If 'deterministic' is true, entries are sorted by name and their
+    timestamps and permissions normalized, so that the same contents
+    always produce the same archive.  The archive's content hash is then
+    saved next to it, and the archive is left alone if it's up to date.
+    Other builds remove the saved hash, as they don't match it.
+
+    Returns the name of the output file and its content hash.
+    """
     zip_filename = base_name + ".sublime-package"
+    hash_filename = zip_filename + ".sha256"
     mkpath(os.path.dirname(zip_filename), dry_run=dry_run)
-
-    # If zipfile module is not available, try spawning an external
-    # 'zip' command.
-    if zipfile is None:
+    log.info("creating '%s'", zip_filename)
+    if dry_run:
+        return zip_filename, None
+
+    mkpath(cache_dir)
+    cache = load_package_cache(cache_dir)
+    new_cache = {}
+    stats = {}
+    stale = []
+    for file in files:
+        if not os.path.isfile(file):
+            log.warn("'%s' not a regular file -- skipping" % file)
+            continue
+        st = stats[file] = os.stat(file)
+        entry = cache.get(file)
+        if (entry and entry[0] == st.st_mtime and entry[1] == st.st_size
+                and os.path.isfile(os.path.join(cache_dir, entry[2] + ".z"))):
+            new_cache[file] = entry
+        else:
+            stale.append(file)
+
+    # Files can be touched without changing (e.g. by switching branches),
+    # so look up the compressed entries of the rest by their contents.
+    by_md5 = {}
+    for entry in cache.values():
+        by_md5[entry[2]] = entry
+    md5s = {}
+    changed = []
+    for file, md5 in zip(stale, parallel_map(hash_file, stale)):
+        entry = by_md5.get(md5)
+        if entry and os.path.isfile(os.path.join(cache_dir, md5 + ".z")):
+            new_cache[file] = [stats[file].st_mtime, entry[1], md5, entry[3]]
+        else:
+            md5s[file] = md5
+            changed.append(file)
+
+    names = [file for file in files if file in stats]
+    if deterministic:
+        names.sort(key=lambda file: file.replace(os.sep, '/'))
+    extras = [(arcname, compress_data(contents))
+              for arcname, contents in extra_files]
+    digest = content_hash(
+        [(file.replace(os.sep, '/'), md5s.get(file) or new_cache[file][2])
+         for file in names] +
+        [(arcname, compressed[0]) for arcname, compressed in extras])
+
+    if (deterministic and os.path.isfile(zip_filename)
+            and os.path.isfile(hash_filename)
+            and read_file(hash_filename).strip() == digest):
+        log.info("'%s' is up to date (content hash %s)",
+                 zip_filename, digest)
+        save_package_cache(cache_dir, new_cache)
+        return zip_filename, digest
+
+    log.info("reusing %d cached entries, compressing %d file(s)",
+             len(new_cache), len(changed))
+    for file, (md5, crc, size, data) in zip(changed,
+                                            parallel_map(compress_file, changed)):
         if verbose:
-            zipoptions = "-r"
+            log.info("compressing '%s'" % file)
+        f = open(os.path.join(cache_dir, md5 + ".z"), 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        new_cache[file] = [stats[file].st_mtime, size, md5, crc]
+
+    entries = []
+    for file in names:
+        mtime, size, md5, crc = new_cache[file]
+        data = read_file(os.path.join(cache_dir, md5 + ".z"))
+        if deterministic:
+            entries.append((file, None, ZIP_DETERMINISTIC_MODE, crc, size, data))
         else:
-            zipoptions = "-rq"
+            entries.append((file, mtime, stats[file].st_mode, crc, size, data))
 
-        try:
-            spawn(["zip", zipoptions, zip_filename, base_dir],
-                  dry_run=dry_run)
-        except DistutilsExecError:
-            # XXX really should distinguish between "couldn't find
-            # external 'zip' command" and "zip failed".
-            raise DistutilsExecError, \
-                  ("unable to create zip file '%s': "
-                   "could neither import the 'zipfile' module nor "
-                   "find a standalone zip utility") % zip_filename
+    if deterministic:
+        now = None
+    else:
+        now = time.time()
+    for arcname, (md5, crc, size, data) in extras:
+        entries.append((arcname, now, stat.S_IFREG | 0644, crc, size, data))
+
+    write_zipfile(zip_filename, entries)
+    if deterministic:
+        file_util.write_file(hash_filename, [digest])
+    elif os.path.isfile(hash_filename):
+        os.remove(hash_filename)
+    save_package_cache(cache_dir, new_cache)
+    log.info("content hash of '%s' is %s", zip_filename, digest)
+    return zip_filename, digest
+
+
+def glob_to_re (pattern):
+    """Translate the shell-style 'pattern' to a regular expression.  As in
+    'distutils.filelist', wildcards don't match path separators.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        i = i + 1
+        if c == '*':
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j = j + 1
+            if j < n and pattern[j] == ']':
+                j = j + 1
+            j = pattern.find(']', j)
+            if j == -1:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+def match_prefix (prefix_res, dir):
+    """Compare the directory 'dir' component by component with a prefix,
+    given as a list of compiled regular expressions, one per component.
+    Returns None if they don't match, 1 if 'dir' is the prefix or lies
+    below it and 0 if 'dir' is one of the prefix's parents.
+    """
+    parts = dir and dir.split('/') or []
+    for regex, part in zip(prefix_res, parts):
+        if not regex.match(part):
+            return None
+    return len(parts) >= len(prefix_res) and 1 or 0
+
+
+class ManifestRule:
+    """A single include or exclude rule of a manifest.  Paths are always
+    relative to the top directory and use '/' as separator.  'kind' is
+    one of:
+      * 'top': 'pattern' matched against the whole path
+      * 'global': 'pattern' matched against the tail of the path
+      * 'dir': 'pattern' matched below the directories matching 'prefix'
+      * 'tree': everything below the directories matching 'prefix'
+      * 'component': everything below any directory named in 'names'
+    """
+
+    def __init__ (self, include, kind, pattern=None, prefix=None, names=()):
+        self.include = include
+        self.kind = kind
+        self.pattern = pattern
+        self.prefix = prefix
+        self.names = set(names)
+        if prefix is not None:
+            # Prefixes are patterns too.
+            self.prefix_res = [re.compile(glob_to_re(part) + '\\Z')
+                               for part in prefix.split('/')]
+        if kind == 'top':
+            self.regex = glob_to_re(pattern)
+        elif kind == 'global':
+            self.regex = '.*' + glob_to_re(pattern)
+        elif kind == 'dir':
+            self.regex = glob_to_re(prefix) + '/.*' + glob_to_re(pattern)
+        elif kind == 'tree':
+            self.regex = glob_to_re(prefix) + '/.*'
+        elif kind == 'component':
+            self.regex = '(?:.*/)?(?:%s)/.*' % '|'.join(map(re.escape, names))
+        else:
+            raise ValueError("unknown rule kind '%s'" % kind)
+
+    def reaches (self, dir):
+        """Return true if this rule may match some file below 'dir'."""
+        if self.kind == 'top':
+            # Patterns without a separator only match top-level files;
+            # don't bother working out where the others can go.
+            return self.pattern.find('/') != -1
+        if self.kind in ('dir', 'tree'):
+            return match_prefix(self.prefix_res, dir) is not None
+        return 1
+
+    def covers (self, dir):
+        """Return true if this rule matches every file below 'dir'."""
+        if self.kind == 'tree':
+            return match_prefix(self.prefix_res, dir) == 1
+        if self.kind == 'component':
+            return not self.names.isdisjoint(dir.split('/'))
+        return 0
+
+    def key (self):
+        return [self.include, self.kind, self.regex, self.prefix]
+
+# class ManifestRule
+
+
+def parse_template_line (line):
+    """Return the list of 'ManifestRule's for a line of a manifest
+    template.  Raises DistutilsTemplateError if the line is malformed.
+    """
+    words = line.split()
+    action = words[0]
+    include = action in ('include', 'global-include', 'recursive-include',
+                         'graft')
+
+    if action in ('include', 'exclude', 'global-include', 'global-exclude'):
+        if len(words) < 2:
+            raise DistutilsTemplateError, \
+                  "'%s' expects <pattern1> <pattern2> ..." % action
+        kind = action.startswith('global') and 'global' or 'top'
+        return [ManifestRule(include, kind, pattern=word)
+                for word in words[1:]]
+
+    elif action in ('recursive-include', 'recursive-exclude'):
+        if len(words) < 3:
+            raise DistutilsTemplateError, \
+                  "'%s' expects <dir> <pattern1> <pattern2> ..." % action
+        prefix = words[1].rstrip('/')
+        return [ManifestRule(include, 'dir', pattern=word, prefix=prefix)
+                for word in words[2:]]
+
+    elif action in ('graft', 'prune'):
+        if len(words) != 2:
+            raise DistutilsTemplateError, \
+                  "'%s' expects a single <dir_pattern>" % action
+        return [ManifestRule(include, 'tree', prefix=words[1].rstrip('/'))]
 
     else:
-        log.info("creating '%s' and adding '%s' to it",
-                 zip_filename, base_dir)
-
-        if not dry_run:
-            z = zipfile.ZipFile(zip_filename, "w",
-                                compression=zipfile.ZIP_DEFLATED)
-
-            for dirpath, dirnames, filenames in os.walk(base_dir):
-                for name in filenames:
-                    path = os.path.normpath(os.path.join(dirpath, name))
-                    arcname = path[len(base_dir):]
-                    # if dirpath == base_dir:
-                        # arcname = name
-                    # else:
-                        # arcname = path[len(base_dir):]
-                        # print arcname
-                    if os.path.isfile(path):
-                        z.write(path, arcname)
-                        log.info("adding '%s'" % path)
-            z.close()
-
-    return zip_filename
+        raise DistutilsTemplateError, "unknown action '%s'" % action
+
+
+class ManifestMatcher:
+    """All the rules of a manifest compiled into as few regular
+    expressions as possible.  Alternatives are tried from the last rule
+    to the first, so the rule that decides whether a file is included is
+    the same one that would if the rules were applied in turn to a
+    'FileList'.
+    """
+
+    # Python's re module doesn't support more than 100 groups.
+    max_groups = 99
+
+    def __init__ (self, rules):
+        self.rules = rules
+        indexed = list(enumerate(rules))
+        indexed.reverse()
+        self.regexes = []
+        for start in range(0, len(indexed), self.max_groups):
+            alternatives = ['(?P<r%d>%s\\Z)' % (i, rule.regex)
+                            for i, rule in indexed[start:start + self.max_groups]]
+            self.regexes.append(re.compile('|'.join(alternatives), re.S))
+
+    def includes (self, path, default=0):
+        """Return true if 'path' makes it into the manifest.  'default' is
+        the answer if no rule matches 'path'.
+        """
+        for regex in self.regexes:
+            match = regex.match(path)
+            if match:
+                return self.rules[int(match.lastgroup[1:])].include
+        return default
+
+    def may_include_below (self, dir):
+        """Return false if no file below 'dir' can make it into the
+        manifest, so that the directory needn't be walked at all.
+        """
+        result = 0
+        for rule in self.rules:
+            if rule.include:
+                if rule.reaches(dir):
+                    result = 1
+            elif rule.covers(dir):
+                result = 0
+        return result
+
+    def walk (self, cache_file=None):
+        """Return the files below the current directory that make it into
+        the manifest, walking the tree only once and skipping the
+        directories that cannot contain any of them.  If 'cache_file' is
+        given, the result is saved there and reused for as long as the
+        mtimes of the walked directories don't change.
+        """
+        key = [rule.key() for rule in self.rules]
+        if cache_file:
+            files = self.read_cache(cache_file, key)
+            if files is not None:
+                log.info("reusing file list cached in '%s'", cache_file)
+                return files
+
+        dirs = {}
+        files = []
+        for dirpath, dirnames, filenames in os.walk(os.curdir):
+            dir = dirpath[len(os.curdir) + 1:].replace(os.sep, '/')
+            dirs[dir] = os.stat(dirpath).st_mtime
+            prefix = dir and dir + '/'
+            dirnames[:] = [name for name in dirnames
+                           if self.may_include_below(prefix + name)]
+            for name in filenames:
+                path = prefix + name
+                if self.includes(path):
+                    files.append(path.replace('/', os.sep))
+
+        if cache_file:
+            mkpath(os.path.dirname(cache_file))
+            f = open(cache_file, 'w')
+            try:
+                json.dump({'key': key, 'dirs': dirs, 'files': files}, f)
+            finally:
+                f.close()
+        return files
+
+    def read_cache (self, cache_file, key):
+        """Return the file list saved in 'cache_file' by 'walk()', or None
+        if it's missing or out of date.
+        """
+        try:
+            f = open(cache_file)
+            try:
+                cache = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+        if cache.get('key') != key:
+            return None
+        for dir, mtime in cache['dirs'].items():
+            try:
+                if os.stat(dir.replace('/', os.sep) or os.curdir).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+        return cache['files']
+
+# class ManifestMatcher
 
 
 def show_formats ():
@@ -124,11 +599,15 @@ class spa (Command):
         ('dist-dir=', 'd',
          "directory to put the source distribution archive(s) in "
          "[default: dist]"),
+        ('deterministic', None,
+         "create a reproducible archive (sorted entries, normalized "
+         "timestamps and permissions) and skip the build if it's "
+         "up to date"),
         ]
 
     boolean_options = ['use-defaults', 'prune',
                        'manifest-only', 'force-manifest',
-                       'keep-temp']
+                       'keep-temp', 'deterministic']
 
     help_options = [
         ('help-formats', None,
@@ -158,8 +637,10 @@ class spa (Command):
         self.formats = None
         self.keep_temp = 0
         self.dist_dir = None
+        self.deterministic = 0
 
         self.archive_files = None
+        self.content_hashes = None
 
 
     def finalize_options (self):
@@ -293,14 +774,22 @@ class spa (Command):
                 self.warn(("manifest template '%s' does not exist " +
                            "(using default file list)") %
                           self.template)
-            self.filelist.findall()
-
             if self.use_defaults:
                 self.add_defaults()
+            rules = []
             if template_exists:
-                self.read_template()
+                rules.extend(self.read_template())
             if self.prune:
-                self.prune_file_list()
+                rules.extend(self.prune_file_list())
+
+            # Default files are in unless a rule says otherwise; the rest
+            # of the tree is walked once looking for files to include.
+            matcher = ManifestMatcher(rules)
+            self.filelist.files = [
+                file for file in self.filelist.files
+                if matcher.includes(file.replace(os.sep, '/'), default=1)]
+            self.filelist.extend(matcher.walk(
+                os.path.join(SPA_CACHE_DIR, SPA_CACHE_FILELIST)))
 
             self.filelist.sort()
             self.filelist.remove_duplicates()
@@ -375,8 +864,8 @@ class spa (Command):
     def read_template (self):
         """Read and parse manifest template file named by self.template.
 
-        (usually "MANIFEST.in") The parsing and processing is done by
-        'self.filelist', which updates itself accordingly.
+        (usually "MANIFEST.in") Returns the list of 'ManifestRule's in
+        the template, in order.
         """
         log.info("reading manifest template '%s'", self.template)
         template = TextFile(self.template,
@@ -387,24 +876,27 @@ class spa (Command):
                             rstrip_ws=1,
                             collapse_join=1)
 
+        rules = []
         while 1:
             line = template.readline()
             if line is None:            # end of file
                 break
 
             try:
-                self.filelist.process_template_line(line)
+                rules.extend(parse_template_line(line))
             except DistutilsTemplateError, msg:
                 self.warn("%s, line %d: %s" % (template.filename,
                                                template.current_line,
                                                msg))
+        return rules
 
     # read_template ()
 
 
     def prune_file_list (self):
-        """Prune off branches that might slip into the file list as created
-        by 'read_template()', but really don't belong there:
+        """Return the rules that prune off branches that might slip into
+        the file list as created by 'read_template()', but really don't
+        belong there:
           * the build tree (typically "build")
           * the release tree itself (only an issue if we ran "spa"
             previously with --keep-temp, or it aborted)
@@ -414,20 +906,11 @@ class spa (Command):
         base_dir = self.distribution.get_fullname()
         base_dir = self.distribution.get_name()
 
-        self.filelist.exclude_pattern(None, prefix=build.build_base)
-        self.filelist.exclude_pattern(None, prefix=base_dir)
-
-        # pruning out vcs directories
-        # both separators are used under win32
-        if sys.platform == 'win32':
-            seps = r'/|\\'
-        else:
-            seps = '/'
-
-        vcs_dirs = ['RCS', 'CVS', r'\.svn', r'\.hg', r'\.git', r'\.bzr',
-                    '_darcs']
-        vcs_ptrn = r'(^|%s)(%s)(%s).*' % (seps, '|'.join(vcs_dirs), seps)
-        self.filelist.exclude_pattern(vcs_ptrn, is_regex=1)
+        vcs_dirs = ['RCS', 'CVS', '.svn', '.hg', '.git', '.bzr', '_darcs']
+        return [ManifestRule(0, 'tree',
+                             prefix=build.build_base.replace(os.sep, '/')),
+                ManifestRule(0, 'tree', prefix=base_dir),
+                ManifestRule(0, 'component', names=vcs_dirs)]
 
     def write_manifest (self):
         """Write the file list in 'self.filelist' (presumably as filled in
@@ -505,12 +988,13 @@ class spa (Command):
     # make_release_tree ()
 
     def make_distribution (self):
-        """Create the source distribution(s).  First, we create the release
-        tree with 'make_release_tree()'; then, we create all required
-        archive files (according to 'self.formats') from the release tree.
-        Finally, we clean up by blowing away the release tree (unless
-        'self.keep_temp' is true).  The list of archive files created is
-        stored so it can be retrieved later by 'get_archive_files()'.
+        """Create the source distribution(s).  The archive is written
+        straight from the files in 'self.filelist' with
+        'make_sublime_package()', which only compresses the files that
+        changed since the previous build.  The release tree is only
+        created if 'self.keep_temp' is true, so that it can be inspected.
+        The list of archive files created is stored so it can be
+        retrieved later by 'get_archive_files()'.
         """
         # Don't warn about missing meta-data here -- should be (and is!)
         # done elsewhere.
@@ -520,23 +1004,27 @@ class spa (Command):
         # base_dir = "TEST"
         base_name = os.path.join(self.dist_dir, base_dir)
 
+        if self.keep_temp:
+            self.make_release_tree(base_dir, self.filelist.files)
 
-        self.make_release_tree(base_dir, self.filelist.files)
-        archive_files = []              # remember names of files we create
-        # tar archive must be created last to avoid overwrite and remove
-        if 'tar' in self.formats:
-            self.formats.append(self.formats.pop(self.formats.index('tar')))
+        pkg_info = StringIO()
+        self.distribution.metadata.write_pkg_file(pkg_info)
 
+        archive_files = []              # remember names of files we create
+        content_hashes = []
         for fmt in self.formats:
-            # file = self.make_archive(base_name, fmt, base_dir=base_dir)
-            file = make_zipfile(base_name, base_dir=base_dir)
+            file, digest = make_sublime_package(
+                                    base_name, self.filelist.files,
+                                    [('PKG-INFO', pkg_info.getvalue())],
+                                    deterministic=self.deterministic,
+                                    verbose=self.verbose,
+                                    dry_run=self.dry_run)
             archive_files.append(file)
+            content_hashes.append(digest)
             self.distribution.dist_files.append(('spa', '', file))
 
         self.archive_files = archive_files
-
-        if not self.keep_temp:
-            dir_util.remove_tree(base_dir, dry_run=self.dry_run)
+        self.content_hashes = content_hashes
 
     def get_archive_files (self):
         """Return the list of archive files created when the command
@@ -544,6 +1032,13 @@ class spa (Command):
         """
         return self.archive_files
 
+    def get_content_hashes (self):
+        """Return the content hashes of the archive files created when
+        the command was run, in the same order as 'get_archive_files()',
+        or None if the command hasn't run yet.
+        """
+        return self.content_hashes
+
 # class spa
 
 
@@ -562,28 +1057,265 @@ class install(Command):
         print NotImplementedError("Command not implemented yet.")
 
 
-class test(Command):
-    """Does it make sense?"""
+# Outcomes and timings of the last test run, for 'test --failed' and to
+# start the slowest tests first.
+TEST_CACHE_DIR = os.path.join("build", "test")
+TEST_RESULTS = "results.json"
 
-    user_options = [('aa', 'a', 'aa')]
 
-    def initialize_options(self):
-        pass
-    
-    def finalize_options(self):
-        pass
+def setup_test_path (tests_dir):
+    """Put 'tests_dir', with the mocks of the sublime modules, and the
+    package above it at the front of sys.path.
+    """
+    tests_dir = os.path.abspath(tests_dir)
+    for path in (os.path.dirname(tests_dir), tests_dir):
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+
+def iter_tests (suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in iter_tests(test):
+                yield t
+        else:
+            yield test
 
-    def run(self):
-        if os.name == 'nt':
-            subprocess.call(["py.test.exe"])
+def list_tests ((tests_dir, module)):
+    """Return the ids of the tests in 'module'.  If it can't be loaded,
+    the module name is returned instead so that running it reports why.
+    """
+    setup_test_path(tests_dir)
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromName(module)
+    except Exception:
+        return [module]
+    return [test.id() for test in iter_tests(suite)]
+
+class TimedTestResult (unittest.TestResult):
+    """Records an (id, outcome, seconds, details) tuple per test.  The
+    output of each test is captured and only shown if it doesn't pass.
+    """
 
+    def __init__ (self):
+        unittest.TestResult.__init__(self)
+        self.records = []
+
+    def startTest (self, test):
+        unittest.TestResult.startTest(self, test)
+        self.outcome, self.details = "ok", ""
+        self.saved_streams = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.output = StringIO()
+        self.started = time.time()
+
+    def stopTest (self, test):
+        seconds = time.time() - self.started
+        sys.stdout, sys.stderr = self.saved_streams
+        details = self.details
+        if self.outcome in ("fail", "error") and self.output.getvalue():
+            details += "\nOutput:\n" + self.output.getvalue()
+        self.records.append((test.id(), self.outcome, seconds, details))
+        unittest.TestResult.stopTest(self, test)
+
+    def addError (self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self.outcome = "error"
+        self.details = self._exc_info_to_string(err, test)
+
+    def addFailure (self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self.outcome = "fail"
+        self.details = self._exc_info_to_string(err, test)
+
+    def addSkip (self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self.outcome, self.details = "skip", reason
+
+def run_tests ((tests_dir, ids)):
+    """Run the tests in 'ids' and return their records; see
+    TimedTestResult.
+    """
+    setup_test_path(tests_dir)
+    result = TimedTestResult()
+    for id in ids:
+        try:
+            suite = unittest.defaultTestLoader.loadTestsFromName(id)
+        except Exception:
+            result.records.append((id, "error", 0.0,
+                                   "".join(traceback.format_exc())))
+            continue
+        suite.run(result)
+    return result.records
+
+def load_test_results (path):
+    """Return the results of the last run in 'path', a dict mapping test
+    ids to [outcome, seconds] lists, or an empty dict.
+    """
+    try:
+        f = open(path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def save_test_results (path, results):
+    mkpath(os.path.dirname(path))
+    f = open(path, 'w')
+    try:
+        json.dump(results, f, indent=0, sort_keys=True)
+    finally:
+        f.close()
+
+def group_tests (ids, timings):
+    """Split 'ids' into one chunk per test class, so that fixtures shared
+    by a class are set up in one process, and order the chunks by how
+    long they took last time, slowest first, so that no worker is left
+    with a slow chunk at the end of the run.
+    """
+    chunks = {}
+    for id in ids:
+        chunks.setdefault(id.rsplit(".", 1)[0], []).append(id)
+    def cost (chunk):
+        return sum(timings.get(id, [None, 0.0])[1] for id in chunk)
+    return sorted(chunks.values(), key=cost, reverse=True)
+
+
+class test (Command):
+
+    description = "run the tests in parallel worker processes"
+
+    user_options = [
+        ('tests-dir=', 'd',
+         "directory with the test modules and the mocks of the sublime "
+         "modules [default: tests]"),
+        ('pattern=', 'p',
+         "file name pattern of the test modules [default: test_*.py]"),
+        ('workers=', 'j',
+         "number of worker processes [default: one per CPU]"),
+        ('failed', 'f',
+         "only rerun the tests that failed in the last run"),
+        ('slowest=', 's',
+         "number of slowest tests to report [default: 10]"),
+        ]
 
+    boolean_options = ['failed']
+
+    def initialize_options (self):
+        self.tests_dir = None
+        self.pattern = None
+        self.workers = None
+        self.failed = 0
+        self.slowest = None
+
+    def finalize_options (self):
+        if self.tests_dir is None:
+            self.tests_dir = "tests"
+        if self.pattern is None:
+            self.pattern = "test_*.py"
+        if self.slowest is None:
+            self.slowest = 10
+        try:
+            if self.workers is not None:
+                self.workers = int(self.workers)
+                if self.workers < 1:
+                    raise ValueError
+            self.slowest = int(self.slowest)
+        except ValueError:
+            raise DistutilsOptionError, \
+                  "'workers' and 'slowest' must be positive numbers"
+        if not os.path.isdir(self.tests_dir):
+            raise DistutilsOptionError, \
+                  "tests directory '%s' does not exist" % self.tests_dir
+
+    def run (self):
+        results_path = os.path.join(TEST_CACHE_DIR, TEST_RESULTS)
+        previous = load_test_results(results_path)
+
+        if self.failed:
+            ids = sorted(id for id, (outcome, seconds) in previous.items()
+                         if outcome in ("fail", "error"))
+            if not ids:
+                log.info("no failed tests to rerun")
+                return
+        else:
+            modules = [os.path.splitext(os.path.basename(path))[0] for path
+                       in sorted(glob(os.path.join(self.tests_dir,
+                                                   self.pattern)))]
+            ids = []
+            for found in parallel_map(list_tests,
+                                      [(self.tests_dir, module)
+                                       for module in modules],
+                                      self.workers):
+                ids.extend(found)
+        if not ids:
+            log.info("no tests found")
+            return
 
-setup(cmdclass={'spa': spa, 'install': install, 'test': test},
-      name='PowershellUtils',
-      version='0.1',
-      description='Commands to extend the multiselection functionality.',
-      author='Guillermo López-Anglada',
-      author_email='guillermo@sublimetext.info',
-      url='http://sublimetext.info',
-     )
\ No newline at end of file
+        started = time.time()
+        chunks = group_tests(ids, previous)
+        records = []
+        # Each chunk gets a process of its own: tests leave module state
+        # behind, such as stand-ins patched into the sublime module.
+        for chunk_records in parallel_map(run_tests,
+                                          [(self.tests_dir, chunk)
+                                           for chunk in chunks],
+                                          self.workers, 1, 1):
+            records.extend(chunk_records)
+        elapsed = time.time() - started
+
+        self.report(records, elapsed)
+
+        # A rerun of the failures keeps the rest of the last run, so
+        # that tests which keep failing can be rerun again.
+        if not self.failed:
+            previous = {}
+        for id, outcome, seconds, details in records:
+            previous[id] = [outcome, round(seconds, 4)]
+        save_test_results(results_path, previous)
+
+        failed = [r for r in records if r[1] in ("fail", "error")]
+        if failed:
+            raise DistutilsError, \
+                  "%d of %d tests failed; rerun them with " \
+                  "'setup.py test --failed'" % (len(failed), len(records))
+
+    def report (self, records, elapsed):
+        for id, outcome, seconds, details in records:
+            if outcome in ("fail", "error"):
+                print "=" * 70
+                print "%s: %s" % (outcome.upper(), id)
+                print "-" * 70
+                print details
+
+        if self.slowest:
+            print "slowest tests:"
+            slowest = sorted(records, key=lambda r: r[2], reverse=True)
+            for id, outcome, seconds, details in slowest[:self.slowest]:
+                print "  %8.3fs %-5s %s" % (seconds, outcome, id)
+
+        counts = {}
+        for record in records:
+            counts[record[1]] = counts.get(record[1], 0) + 1
+        log.info("ran %d tests in %.3fs (%.3fs in tests): %d passed, "
+                 "%d failed, %d errors, %d skipped",
+                 len(records), elapsed, sum(r[2] for r in records),
+                 counts.get("ok", 0), counts.get("fail", 0),
+                 counts.get("error", 0), counts.get("skip", 0))
+
+# class test
+
+
+
+# 'spa' compresses files in worker processes, which import this module
+# again on Windows.
+if __name__ == '__main__':
+    setup(cmdclass={'spa': spa, 'install': install, 'test': test},
+          name='PowershellUtils',
+          version='0.1',
+          description='Commands to extend the multiselection functionality.',
+          author='Guillermo López-Anglada',
+          author_email='guillermo@sublimetext.info',
+          url='http://sublimetext.info',
+         )
\ No newline at end of file
@@ -1,7 +1,176 @@
 # Path management utilities for Sublime plugin dev.
 # TODO: This will eventually be moved to a separate package.
+from __future__ import with_statement
 import sublime
 import os
+import stat
+import ctypes
+import tempfile
+import threading
+import contextlib
 
 def rootAtPackagesDir(*leaf):
     return os.path.join(sublime.packages_path(), *leaf)
+
+def _renameOver(src, dst):
+    if os.name == 'nt':
+        # os.rename() won't replace an existing file on Windows.
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        MOVEFILE_WRITE_THROUGH = 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                        MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+def _syncDir(path):
+    # Make the rename itself durable; not possible (nor needed) on Windows.
+    if os.name != 'nt':
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def _umask():
+    # Linux tells it without changing it.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (IOError, ValueError, IndexError):
+        pass
+    # Elsewhere it can only be read by setting it, which affects every
+    # thread for that moment.
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+_newFileModeLock = threading.Lock()
+_NEW_FILE_MODE = None
+
+def _newFileMode():
+    """What open() would give a new file; mkstemp() always gives 0600."""
+    global _NEW_FILE_MODE
+    with _newFileModeLock:
+        if _NEW_FILE_MODE is None:
+            _NEW_FILE_MODE = 0666 & ~_umask()
+        return _NEW_FILE_MODE
+
+def _makeTemp(path):
+    # In the same directory, so that it can be renamed over path, and
+    # with path's permissions, which the rename would otherwise replace.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path) + '.')
+    try:
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            mode = _newFileMode()
+        os.chmod(tmp, mode)
+    except:
+        os.close(fd)
+        os.remove(tmp)
+        raise
+    return fd, tmp
+
+def _writeTemp(path, data):
+    """Write data to a synced temporary file next to path; return its name."""
+    fd, tmp = _makeTemp(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    except:
+        os.remove(tmp)
+        raise
+    return tmp
+
+@contextlib.contextmanager
+def atomicWrite(path, sync=True):
+    """
+    Yields a binary file whose contents replace path's when the block
+    exits without errors. Readers see either the old or the new file,
+    never a truncated one. If sync is true, the data is on disk when the
+    block exits, not just in the OS' cache.
+    """
+    fd, tmp = _makeTemp(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        _renameOver(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync:
+        _syncDir(path)
+
+def replaceFile(path, data, sync=True):
+    """Replaces the contents of path with data, all or nothing."""
+    with atomicWrite(path, sync) as f:
+        f.write(data)
+
+
+class GroupCommit(object):
+    """
+    Replaces files atomically in a background thread. Writes requested
+    within delay seconds of the first one are committed together: only
+    the latest data for each path is written, and every file is synced
+    before any of them is renamed into place. callback, if given, is
+    called from the background thread with None or the error.
+    """
+
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.lock = threading.Lock()
+        # Commits run one at a time so that later data always wins.
+        self.commitLock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+
+    def write(self, path, data, callback=None):
+        with self.lock:
+            callbacks = self.pending.get(path, (None, []))[1]
+            if callback:
+                callbacks.append(callback)
+            self.pending[path] = (data, callbacks)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.start()
+
+    def flush(self):
+        """Commits the pending writes now."""
+        with self.commitLock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+            written = []
+            for path, (data, callbacks) in pending.items():
+                try:
+                    written.append((path, _writeTemp(path, data), callbacks))
+                except EnvironmentError, e:
+                    self._notify(callbacks, e)
+
+            for path, tmp, callbacks in written:
+                try:
+                    _renameOver(tmp, path)
+                    _syncDir(path)
+                except EnvironmentError, e:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    self._notify(callbacks, e)
+                else:
+                    self._notify(callbacks, None)
+
+    def _notify(self, callbacks, error):
+        for callback in callbacks:
+            callback(error)
@@ -0,0 +1,114 @@
+"""Benchmark the manifest engine in setup.py against distutils' FileList.
+
+Builds a synthetic tree with ~100k files in a temporary directory, computes
+the file list for the same template with both and checks that they agree.
+
+Usage: python bench_manifest.py [number of files]
+"""
+
+import _setuptestenv
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+from distutils import log
+from distutils.filelist import FileList
+
+import setup
+
+
+TEMPLATE = """\
+include *.py *.rst
+recursive-include pkg* *.py *.txt
+global-exclude *.pyc
+exclude pkg0/*.txt
+prune pkg1/sub0
+graft data
+"""
+
+VCS_PATTERN = r'(^|/)(RCS|CVS|\.svn|\.hg|\.git|\.bzr|_darcs)/.*'
+
+
+def make_tree(root, count):
+    """Create roughly 'count' files under 'root', some of them in
+    directories that the template prunes.
+    """
+    def touch(*parts):
+        path = os.path.join(root, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    for name in ('setup.py', 'README.rst', 'module.py', 'notes.txt'):
+        touch(name)
+
+    per_dir = 50
+    exts = ('.py', '.pyc', '.txt', '.dat')
+    made = 4
+    i = 0
+    while made < count:
+        top = ('pkg%d' % (i % 20), '.git', 'build', 'data', 'test')[i % 5]
+        for j in range(per_dir):
+            touch(top, 'sub%d' % (i // 5 % 40), 'f%d_%d%s' % (i, j, exts[j % 4]))
+        made += per_dir
+        i += 1
+
+
+def filelist_files():
+    filelist = FileList()
+    filelist.findall()
+    for line in TEMPLATE.splitlines():
+        filelist.process_template_line(line)
+    filelist.exclude_pattern(None, prefix='build')
+    filelist.exclude_pattern(None, prefix='PowershellUtils')
+    filelist.exclude_pattern(VCS_PATTERN, is_regex=1)
+    return filelist.files
+
+
+def matcher():
+    rules = []
+    for line in TEMPLATE.splitlines():
+        rules.extend(setup.parse_template_line(line))
+    rules.extend([setup.ManifestRule(0, 'tree', prefix='build'),
+                  setup.ManifestRule(0, 'tree', prefix='PowershellUtils'),
+                  setup.ManifestRule(0, 'component',
+                                     names=['RCS', 'CVS', '.svn', '.hg',
+                                            '.git', '.bzr', '_darcs'])])
+    return setup.ManifestMatcher(rules)
+
+
+def timed(label, func):
+    start = time.time()
+    result = func()
+    print "%-24s %8.3fs  %d files" % (label, time.time() - start, len(result))
+    return result
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    log.set_threshold(log.WARN)
+    root = tempfile.mkdtemp()
+    cache_file = os.path.join(tempfile.mkdtemp(), 'filelist.json')
+    old_cwd = os.getcwd()
+    try:
+        make_tree(root, count)
+        os.chdir(root)
+        expected = timed("distutils FileList", filelist_files)
+        actual = timed("ManifestMatcher (cold)",
+                       lambda: matcher().walk(cache_file))
+        cached = timed("ManifestMatcher (cached)",
+                       lambda: matcher().walk(cache_file))
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(root)
+        shutil.rmtree(os.path.dirname(cache_file))
+
+    if sorted(expected) != sorted(actual) or sorted(actual) != sorted(cached):
+        print "ERROR: file lists differ"
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
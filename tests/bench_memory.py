@@ -0,0 +1,159 @@
+"""Measure the peak memory used to write the filter script and to send it
+to a host.
+
+For each input size, a child process builds the regions, then writes the
+script either with build_script() or by formatting the whole template like
+earlier versions did, and reports how much its peak memory grew. Other
+children send a script of that size to a host process with
+HostRunner.run_script(), or by reading and encoding all of it like earlier
+versions did. The growth should stay a small constant factor of the input
+size.
+
+Usage: python bench_memory.py [megabytes of input ...]
+"""
+
+import _setuptestenv
+import os
+import sys
+import subprocess
+import tempfile
+import codecs
+import ctypes
+
+import mock
+import sublime
+
+sublime.packages_path = mock.Mock()
+sublime.packages_path.return_value = "XXX"
+
+import executepscommand
+import poshrunner
+
+
+# Growth of the peak, relative to the input size, that build_script()
+# and HostRunner.run_script() must stay under.
+MAX_RATIO = 0.5
+
+# Answers every request at once without running anything.
+SINK_HOST = r"""
+import sys
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    sys.stdout.write("done %s \n" % line.split("\t")[2])
+    sys.stdout.flush()
+"""
+
+
+class SinkRunner(poshrunner.ProcessRunner):
+    name = "sink"
+
+    def host_cmd_line(self):
+        return [sys.executable, "-c", SINK_HOST]
+
+
+def peak_memory():
+    """Return the peak memory used by this process in bytes."""
+    if os.name == 'nt':
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong),
+                        ("PageFaultCount", ctypes.c_ulong),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but on OS X.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def old_build_script(texts, userPoShCmd, path):
+    with codecs.open(path, 'w', 'utf_8_sig') as f:
+        f.write(executepscommand.PoSh_SCRIPT_TEMPLATE %
+                    (executepscommand.texts_to_posh_array(texts), userPoShCmd))
+
+
+def old_run_script(runner, path):
+    with open(path, 'rb') as f:
+        script = f.read()
+    return runner.host().request("run", None, script)
+
+
+def write_script(path, size):
+    chunk = "x" * 65536
+    with open(path, 'wb') as f:
+        for i in range(0, size, len(chunk)):
+            f.write(chunk[:size - i])
+
+
+def child(method, size):
+    fd, path = tempfile.mkstemp(suffix=".ps1")
+    os.close(fd)
+    try:
+        if method in ("host", "host-old"):
+            write_script(path, size)
+            runner = poshrunner.HostRunner(SinkRunner())
+            # Start the host before measuring.
+            runner.run_command(u"")
+            before = peak_memory()
+            if method == "host-old":
+                old_run_script(runner, path)
+            else:
+                runner.run_script(path)
+            runner.host().proc.stdin.close()
+            runner.host().proc.wait()
+        else:
+            # 1000 regions, one in ten with a quote to escape.
+            texts = [(u"x" * 99 + (u"'" if i % 10 else u"x")) * (size / 100000)
+                     for i in range(1000)]
+            before = peak_memory()
+            build = old_build_script if method == "old" else executepscommand.build_script
+            build(texts, u"$_.toupper()", path)
+        print peak_memory() - before
+    finally:
+        os.remove(path)
+
+
+def measure(method, size):
+    out = subprocess.Popen([sys.executable, __file__, "--child", method, str(size)],
+                           stdout=subprocess.PIPE).communicate()[0]
+    return int(out)
+
+
+def main():
+    sizes = [int(float(mb) * 1024 * 1024) for mb in sys.argv[1:]] or \
+            [mb * 1024 * 1024 for mb in (8, 16, 32)]
+    failed = []
+    print "%10s %14s %14s %14s %14s" % ("input", "build_script", "old template",
+                                        "run_script", "old host")
+    for size in sizes:
+        ratios = [float(measure(method, size)) / size
+                  for method in ("new", "old", "host", "host-old")]
+        print "%8.1fMB %12.2fx %12.2fx %12.2fx %12.2fx" % ((size / 1048576.0,) + tuple(ratios))
+        if ratios[0] > MAX_RATIO:
+            failed.append("build_script")
+        if ratios[2] > MAX_RATIO:
+            failed.append("HostRunner.run_script")
+    for name in sorted(set(failed)):
+        print "ERROR: %s's peak memory grows with the input size" % name
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
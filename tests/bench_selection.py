@@ -0,0 +1,124 @@
+"""Benchmark how FilterRun reads the selection and applies outputs.
+
+A fake view with many selected regions is filtered the way FilterRun does
+it: the selected text is read, then the output frames for the regions are
+handed to FilterRun.on_line() in random order, and FilterRun.apply() runs
+for each group of frames that arrived together. The old way looks the
+tracked regions up with view.get_regions() for every group, so it's only
+run up to a size where it finishes in reasonable time.
+
+Usage: python bench_selection.py [number of selections] [outputs per group]
+"""
+
+import _setuptestenv
+import sys
+import time
+import base64
+import random
+
+import mock
+import sublime
+
+sublime.packages_path = mock.Mock()
+sublime.packages_path.return_value = "XXX"
+
+import executepscommand
+
+
+class Region(object):
+
+    def __init__(self, a, b):
+        self.a, self.b = a, b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+
+class FakeView(object):
+    """
+    Behaves like the API: every call returns fresh objects. Replacements
+    are only counted; the text never changes.
+    """
+
+    def __init__(self, count):
+        self.text = "".join("word%06d " % i for i in range(count))
+        self.selection = [(i * 11, i * 11 + 10) for i in range(count)]
+        self.regions = {}
+        self.replaced = 0
+
+    def sel(self):
+        return [Region(a, b) for a, b in self.selection]
+
+    def substr(self, r):
+        return self.text[r.begin():r.end()]
+
+    def add_regions(self, key, regions, *args):
+        self.regions[key] = [(r.begin(), r.end()) for r in regions]
+
+    def get_regions(self, key):
+        return [Region(a, b) for a, b in self.regions[key]]
+
+    def change_count(self):
+        return self.replaced
+
+    def replace(self, edit, r, text):
+        self.replaced += 1
+
+
+class OldFilterRun(executepscommand.FilterRun):
+    """Looks the tracked regions up on every call to apply()."""
+
+    def apply(self):
+        with self.lock:
+            frames, self.frames = self.frames, []
+            self.apply_scheduled = False
+        regions = self.views[0].get_regions(executepscommand.PENDING_REGIONS_KEY)
+        for kind, i, text in sorted(frames, reverse=True):
+            self.views[0].replace(None, regions[i], text)
+            self.replaced += 1
+
+
+def filter_view(cls, view, order, group):
+    run = cls([view], u"$_.toupper()", None, None)
+    snapshot = executepscommand.SelectionSnapshot(view, executepscommand.PENDING_REGIONS_KEY)
+    run.snapshots, run.offsets, run.edits = [snapshot], [0], [None]
+    texts = snapshot.texts()
+    frames = ["out %d %s\n" % (i, base64.b64encode(texts[i].upper())) for i in order]
+    callbacks = []
+    sublime.set_timeout = lambda f, delay: callbacks.append(f)
+    start = time.time()
+    for g in range(0, len(frames), group):
+        for line in frames[g:g + group]:
+            run.on_line(0, line)
+        callbacks.pop()()
+    return time.time() - start
+
+
+def timed(label, cls, count, group):
+    view = FakeView(count)
+    order = range(count)
+    random.Random(0).shuffle(order)
+    seconds = filter_view(cls, view, order, group)
+    print "%-30s %8d selections %8.3fs" % (label, count, seconds)
+    assert view.replaced == count
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    group = len(sys.argv) > 2 and int(sys.argv[2]) or 1000
+    sublime.Region = Region
+    # The old way is quadratic: it takes minutes long before 100k.
+    for n in (count / 100, count / 50):
+        timed("get_regions(), grouped by 1", OldFilterRun, n, 1)
+    for n in (count / 100, count / 10):
+        timed("get_regions(), grouped by %d" % group, OldFilterRun, n, group)
+    for n in (count / 100, count / 10, count):
+        timed("FilterRun, grouped by 1", executepscommand.FilterRun, n, 1)
+        timed("FilterRun, grouped by %d" % group, executepscommand.FilterRun, n, group)
+
+
+if __name__ == "__main__":
+    main()
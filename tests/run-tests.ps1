@@ -1,7 +1,9 @@
-$__old_PYTHONPATH = $env:PYTHONPATH
-$env:PYTHONPATH = (resolve-path "..").providerpath
-
-# run tests here
-get-item "test_*.py" | foreach-object { & $_ }
-
-$env:PYTHONPATH = $__old_PYTHONPATH
+# Runs every test_*.py here in parallel; pass -f to rerun only the tests
+# that failed last time. See 'python setup.py test --help' for the rest.
+push-location ".."
+try {
+    & python setup.py test @args
+}
+finally {
+    pop-location
+}
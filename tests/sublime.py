@@ -1,6 +1,28 @@
+# A stand-in for the sublime module, which only exists inside the editor.
+# Tests that depend on what these return patch them with mock.
+
+HIDDEN = 128
+DRAW_OUTLINED = 2
+QUICK_PANEL_MONOSPACE_FONT = 1
+
 def packagesPath():
     return "?????"
 
+def packages_path():
+    return "?????"
+
+def set_timeout(callback, delay):
+    callback()
+
+def status_message(message):
+    pass
+
+def error_message(message):
+    pass
+
+def windows():
+    return []
+
 class View(object):
     pass
 
@@ -8,10 +30,28 @@ class Window(object):
     pass
 
 class Region(object):
-    pass
+
+    def __init__(self, a=0, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def __repr__(self):
+        return "Region(%d, %d)" % (self.a, self.b)
 
 class RegionSet(object):
     pass
 
 class Options(object):
-    pass
\ No newline at end of file
+    pass
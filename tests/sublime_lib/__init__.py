@@ -0,0 +1 @@
+# A stand-in for sublime_lib, which is installed as a separate package.
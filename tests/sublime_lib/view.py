@@ -0,0 +1,6 @@
+# A stand-in for sublime_lib.view with the helpers the plugin uses.
+
+def append(view, text):
+    edit = view.begin_edit()
+    view.insert(edit, view.size(), text)
+    view.end_edit(edit)
@@ -0,0 +1,18 @@
+# A stand-in for the sublime_plugin module of Sublime Text 2; see
+# sublimeplugin.py for the old API.
+
+class TextCommand(object):
+
+    def __init__(self, view):
+        self.view = view
+
+class WindowCommand(object):
+
+    def __init__(self, window):
+        self.window = window
+
+class ApplicationCommand(object):
+    pass
+
+class EventListener(object):
+    pass
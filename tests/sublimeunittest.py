@@ -1,20 +1,20 @@
 import sys
 import os
 
-# TODO: paths are hardcoded!
 THIS_FILE_DIR = os.path.abspath(os.path.split(__file__)[0])
 PATH_TO_MODULE_TO_TEST = os.path.abspath(os.path.join(THIS_FILE_DIR, ".."))
-RELEASE_PATH = os.path.abspath(os.path.join(os.path.split(__file__)[0], "../../SublimePluginTesting/sublimemocks"))
-DEV_PATH = os.path.abspath(os.path.join(os.path.split(__file__)[0], "../../XXXSublimePluginTesting/sublimemocks"))
-DEBUG = os.path.exists(DEV_PATH)
-PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK = DEV_PATH if DEBUG else RELEASE_PATH
+# The mocks of the sublime modules live next to the tests; point
+# SUBLIME_TEST_FRAMEWORK at another directory to use a different set.
+PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK = os.path.abspath(
+                os.environ.get("SUBLIME_TEST_FRAMEWORK", THIS_FILE_DIR))
 
 
 class SublimeTextUnitTestError(Exception):
     pass
 
 
-if not os.path.exists(PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK):
-    raise SublimeTextUnitTestError("Cannot find path to test framework (is it installed?).")
+if not os.path.exists(os.path.join(PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK, "sublime.py")):
+    raise SublimeTextUnitTestError("Cannot find the sublime mocks in %s." %
+                                   PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK)
 
 sys.path = [PATH_TO_MODULE_TO_TEST, PATH_TO_SUBLIMETEXT_TEST_FRAMEWORK] + sys.path
@@ -0,0 +1,153 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import adaptivebatch
+
+
+class TestCase_AdaptiveBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "psbatch.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def drain(self, batcher, overhead, per_item):
+        """Run every batch on worker 0 with a simulated cost."""
+        batches = []
+        while True:
+            batch = batcher.next_batch(0)
+            if batch is None:
+                return batches
+            batches.append(batch)
+            batcher.record(batch, overhead + batch[1] * per_item)
+
+    def run_side_by_side(self, batcher, slowdown):
+        """Run a batch on each of two workers, slowed down by slowdown."""
+        batches = [batcher.next_batch(0), batcher.next_batch(1)]
+        for batch in batches:
+            batcher.record(batch, slowdown * (batcher.overhead + batch[1] * batcher.per_item))
+
+    def test_FirstBatchesProbeTheCosts(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000)
+
+        batches = self.drain(batcher, 0.5, 0.001)
+
+        self.assertEquals((0, 1), batches[0])
+        self.assertEquals((1, adaptivebatch.PROBE_BATCH_SIZE), batches[1])
+
+    def test_SmallRunsAreSentInOneBatch(self):
+        batcher = adaptivebatch.AdaptiveBatcher(3)
+
+        self.assertEquals([(0, 3)], self.drain(batcher, 0.5, 0.001))
+
+    def test_SmallRunsAreSentInOneBatchEvenWithEstimates(self):
+        batcher = adaptivebatch.AdaptiveBatcher(adaptivebatch.SINGLE_BATCH_MAX_ITEMS)
+        batcher.overhead, batcher.per_item = 0.01, 0.1
+
+        self.assertEquals(1, batcher.workers())
+        self.assertEquals([(0, adaptivebatch.SINGLE_BATCH_MAX_ITEMS)],
+                          self.drain(batcher, 0.01, 0.1))
+
+    def test_UnsplitRunsAreSentInOneBatch(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000, split=False)
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+
+        self.assertEquals(1, batcher.workers())
+        self.assertEquals([(0, 1000)], self.drain(batcher, 0.5, 0.001))
+
+    def test_CostsAreFittedFromTimings(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000)
+
+        self.drain(batcher, 0.5, 0.001)
+
+        self.assertAlmostEquals(0.5, batcher.overhead)
+        self.assertAlmostEquals(0.001, batcher.per_item)
+
+    def test_EveryItemIsBatchedOnce(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000)
+
+        batches = self.drain(batcher, 0.5, 0.001)
+
+        self.assertEquals(range(1000),
+                          [i for start, count in batches
+                             for i in range(start, start + count)])
+
+    def test_ExpensiveRoundTripsMakeLargerBatches(self):
+        cheap = adaptivebatch.AdaptiveBatcher(100000, max_workers=1)
+        cheap.overhead, cheap.per_item = 0.01, 0.001
+        costly = adaptivebatch.AdaptiveBatcher(100000, max_workers=1)
+        costly.overhead, costly.per_item = 0.5, 0.001
+
+        self.assertTrue(costly.batch_size() > cheap.batch_size())
+
+    def test_BatchesDontExceedMaxSeconds(self):
+        batcher = adaptivebatch.AdaptiveBatcher(100000, max_workers=1)
+        batcher.overhead, batcher.per_item = 10.0, 0.1
+
+        self.assertEquals(int(adaptivebatch.MAX_BATCH_SECONDS / 0.1),
+                          batcher.batch_size())
+
+    def test_WorkersWaitForTheProbes(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000)
+
+        self.assertEquals(None, batcher.next_batch(1))
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+        self.assertEquals(2, batcher.workers())
+
+    def test_WorkersAreAddedWhileTheyPayOff(self):
+        batcher = adaptivebatch.AdaptiveBatcher(100000)
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+
+        self.run_side_by_side(batcher, 1.0)
+
+        self.assertEquals(3, batcher.workers())
+
+    def test_WorkersThatSlowOthersDownAreDropped(self):
+        batcher = adaptivebatch.AdaptiveBatcher(100000)
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+
+        self.run_side_by_side(batcher, 2.0)
+
+        self.assertEquals(1, batcher.workers())
+        self.assertEquals(None, batcher.next_batch(1))
+
+    def test_BatchesRunSideBySideDontSkewTheFit(self):
+        batcher = adaptivebatch.AdaptiveBatcher(100000)
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+
+        self.run_side_by_side(batcher, 3.0)
+
+        self.assertEquals((0.5, 0.001), (batcher.overhead, batcher.per_item))
+
+    def test_SerialRunnersGetOneWorker(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000, concurrent=False)
+        batcher.overhead, batcher.per_item = 0.5, 0.001
+
+        self.assertEquals(1, batcher.workers())
+
+    def test_StoppedBatcherHandsOutNothing(self):
+        batcher = adaptivebatch.AdaptiveBatcher(1000)
+        batcher.stop()
+
+        self.assertEquals(None, batcher.next_batch(0))
+
+    def test_EstimatesArePersistedPerCommand(self):
+        key = adaptivebatch.command_key("pwsh", "$_.toupper()")
+        batcher = adaptivebatch.AdaptiveBatcher(1000, key, self.path)
+        self.drain(batcher, 0.5, 0.001)
+        batcher.save()
+
+        later = adaptivebatch.AdaptiveBatcher(1000, key, self.path)
+        other = adaptivebatch.AdaptiveBatcher(1000, adaptivebatch.command_key("pwsh", "sort"),
+                                              self.path)
+
+        self.assertAlmostEquals(0.5, later.overhead)
+        self.assertEquals(None, other.per_item)
+
+
+if __name__ == "__main__":
+    unittest.main()
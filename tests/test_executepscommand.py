@@ -2,12 +2,20 @@ import unittest
 import mock
 import sublime
 import ctypes
+import base64
+import codecs
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 sublime.packagesPath = mock.Mock()
 sublime.packagesPath.return_value = "XXX"
 
 import sublimeplugin
 import executepscommand
+import poshrunner
 
 class SimpleTestCase(unittest.TestCase):
 
@@ -80,6 +88,608 @@ class TestCase_Helpers(unittest.TestCase):
         self.assertEquals(expected, actual)
 
 
+class TestCase_Outputs(unittest.TestCase):
+
+    def setUp(self):
+        self.output = "\n".join([
+                        "out 0 %s" % base64.b64encode("ONE\r\n"),
+                        "noise written by the user's command",
+                        "err 1 %s" % base64.b64encode("Bad thing.\r\n\r\n"),
+                        "out 2 %s" % base64.b64encode("\r\n"),
+                        ""])
+
+    def test_OutputsAreMappedToRegionIndexes(self):
+        outputs, errors = executepscommand.get_outputs(self.output)
+
+        self.assertEquals({0: "ONE", 2: ""}, outputs)
+
+    def test_ErrorsAreMappedToRegionIndexes(self):
+        outputs, errors = executepscommand.get_outputs(self.output)
+
+        self.assertEquals({1: "Bad thing."}, errors)
+
+    def test_LinesThatArentFramesAreIgnored(self):
+        self.assertEquals(None, executepscommand.parse_frame("out 0 ???"))
+
+
+class TestCase_BuildScript(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "psbuff.ps1")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ScriptIsTheFilledInTemplate(self):
+        texts = [u"one", u"it's", u"\xe9"]
+
+        executepscommand.build_script(texts, u"$_.toupper()", self.path)
+
+        expected = executepscommand.PoSh_SCRIPT_TEMPLATE % (
+                        executepscommand.texts_to_posh_array(texts), u"$_.toupper()")
+        self.assertEquals(codecs.BOM_UTF8 + expected.encode('utf-8'),
+                          open(self.path, 'rb').read())
+
+    def test_TextsAreConsumedLazily(self):
+        texts = iter([u"one", u"two"])
+
+        executepscommand.build_script(texts, u"$_", self.path)
+
+        self.assertTrue("'one','two'" in open(self.path, 'rb').read())
+
+
+class TestCase_Preflight(unittest.TestCase):
+
+    def setUp(self):
+        executepscommand._preflight_cache.clear()
+        self.runner = poshrunner.FakeRunner()
+
+    def test_SyntaxErrorsAreFound(self):
+        self.assertEquals((10, "Missing closing ')'."),
+                          executepscommand.preflight(u"$_.toupper(", self.runner))
+
+    def test_ResultsAreCached(self):
+        self.runner.parse = mock.Mock(return_value=(None, True))
+
+        executepscommand.preflight(u"$_.toupper()", self.runner)
+        executepscommand.preflight(u"$_.toupper()", self.runner)
+
+        self.assertEquals(1, self.runner.parse.call_count)
+
+    def test_ResultsThatMayChangeAreNotCached(self):
+        self.runner.parse = mock.Mock(return_value=(None, False))
+
+        executepscommand.preflight(u"$_ |", self.runner)
+        self.runner.parse.return_value = (3, u"An empty pipe element is not allowed."), True
+
+        self.assertEquals((3, u"An empty pipe element is not allowed."),
+                          executepscommand.preflight(u"$_ |", self.runner))
+
+    def test_ErrorPositionIsShownInTheInputPanel(self):
+        old_region = getattr(sublime, "Region", None)
+        sublime.Region = lambda a, b: (a, b)
+        window = mock.Mock()
+        on_done = mock.Mock()
+        try:
+            executepscommand.show_syntax_error(window, "PoSh cmd:", u"$_.toupper(",
+                                               (10, "Missing closing ')'."), on_done)
+        finally:
+            sublime.Region = old_region
+
+        window.show_input_panel.assert_called_once_with("Missing closing ')'. PoSh cmd:",
+                                                        u"$_.toupper(", on_done, None, None)
+        window.show_input_panel.return_value.sel().add.assert_called_once_with((10, 10))
+
+
+class Region(tuple):
+    """Stand-in for sublime.Region that compares by value."""
+
+    def __new__(cls, a, b):
+        return tuple.__new__(cls, (a, b))
+
+    def begin(self):
+        return min(self)
+
+    def end(self):
+        return max(self)
+
+    def empty(self):
+        return self[0] == self[1]
+
+
+def make_view(regions, text=""):
+    """Return a mock view with regions selected in text."""
+    view = mock.Mock()
+    selection = mock.MagicMock()
+    selection.__iter__.side_effect = lambda: iter([Region(a, b) for a, b in regions])
+    selection.__len__.return_value = len(regions)
+    view.sel.return_value = selection
+    view.substr.side_effect = lambda r: text[r[0]:r[1]]
+    # Regions are tracked as they were added; tests move them with track().
+    tracked = {}
+    view.add_regions.side_effect = lambda key, rs, *args: tracked.__setitem__(key, list(rs))
+    view.get_regions.side_effect = lambda key: list(tracked.get(key, []))
+    view.erase_regions.side_effect = lambda key: tracked.pop(key, None)
+    # Every replacement changes the view.
+    changes = [0]
+    def change(*args):
+        changes[0] += 1
+    view.change_count.side_effect = lambda: changes[0]
+    view.replace.side_effect = change
+    view.change = change
+    return view
+
+def snapshot(view):
+    return executepscommand.SelectionSnapshot(view, executepscommand.PENDING_REGIONS_KEY)
+
+def track(view, regions):
+    """Move the tracked regions, as if someone else had edited the view."""
+    view.add_regions(executepscommand.PENDING_REGIONS_KEY, [Region(a, b) for a, b in regions])
+    view.change()
+
+
+class RegionTestCase(unittest.TestCase):
+    """Replaces sublime.Region and sublime.set_timeout while testing."""
+
+    def setUp(self):
+        self.old_set_timeout = getattr(sublime, "set_timeout", None)
+        self.old_region = getattr(sublime, "Region", None)
+        sublime.set_timeout = lambda f, delay: f()
+        sublime.Region = Region
+
+    def tearDown(self):
+        sublime.set_timeout = self.old_set_timeout
+        sublime.Region = self.old_region
+
+
+class TextView(object):
+    """Just enough of a view's text API for OutputPanel."""
+
+    def __init__(self, text=""):
+        self.text = text
+
+    def size(self):
+        return len(self.text)
+
+    def begin_edit(self):
+        return None
+
+    def end_edit(self, edit):
+        pass
+
+    def insert(self, edit, point, s):
+        self.text = self.text[:point] + s + self.text[point:]
+
+    def erase(self, edit, r):
+        self.text = self.text[:r.begin()] + self.text[r.end():]
+
+    def rowcol(self, point):
+        before = self.text[:point]
+        return before.count("\n"), point - (before.rfind("\n") + 1)
+
+    def text_point(self, row, col):
+        point = 0
+        for i in range(row):
+            point = self.text.index("\n", point) + 1
+        return point + col
+
+    def full_line(self, point):
+        end = self.text.find("\n", point)
+        return Region(self.text.rfind("\n", 0, point) + 1,
+                      len(self.text) if end == -1 else end + 1)
+
+
+class TestCase_OutputPanel(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.old_windows = sublime.windows
+        self.timeouts = []
+        sublime.set_timeout = lambda f, delay: self.timeouts.append(f)
+        self.view = TextView()
+        self.window = mock.Mock()
+        self.window.id.return_value = 1
+        self.window.get_output_panel.return_value = self.view
+
+    def tearDown(self):
+        sublime.windows = self.old_windows
+        executepscommand.OutputPanel._panels.clear()
+        RegionTestCase.tearDown(self)
+
+    def write(self, panel, *texts):
+        for text in texts:
+            panel.write(text)
+        while self.timeouts:
+            self.timeouts.pop(0)()
+
+    def test_WritesAreFlushedTogether(self):
+        panel = executepscommand.OutputPanel(self.window)
+        panel.write("one\n")
+        panel.write("two\n")
+
+        self.assertEquals(1, len(self.timeouts))
+        self.timeouts.pop()()
+        self.assertEquals("one\ntwo\n", self.view.text)
+        self.assertEquals(1, self.window.run_command.call_count)
+
+    def test_OldestLinesAreDropped(self):
+        panel = executepscommand.OutputPanel(self.window, max_lines=3)
+        self.write(panel, "1\n2\n3\n", "4\n5\n")
+
+        self.assertEquals("4\n5\n", self.view.text)
+
+    def test_CharacterCapCutsWholeLines(self):
+        panel = executepscommand.OutputPanel(self.window, max_chars=10)
+        self.write(panel, "aaaa\n")
+        self.write(panel, "bb\ncccc\n")
+
+        self.assertEquals("bb\ncccc\n", self.view.text)
+
+    def test_TextBeyondTheCapIsNeverInserted(self):
+        panel = executepscommand.OutputPanel(self.window, max_chars=5)
+        self.view.insert = mock.Mock(wraps=self.view.insert)
+        self.write(panel, "x" * 100)
+
+        self.view.insert.assert_called_once_with(None, 0, "xxxxx")
+
+    def test_PanelsAreSharedPerWindow(self):
+        sublime.windows = lambda: [self.window]
+
+        panel = executepscommand.OutputPanel.for_window(self.window)
+
+        self.assertTrue(panel is executepscommand.OutputPanel.for_window(self.window))
+
+    def test_PanelsOfClosedWindowsAreForgotten(self):
+        sublime.windows = lambda: [self.window]
+        executepscommand.OutputPanel.for_window(self.window)
+        other = mock.Mock()
+        other.id.return_value = 2
+        sublime.windows = lambda: [other]
+
+        executepscommand.OutputPanel.for_window(other)
+
+        self.assertEquals([2], executepscommand.OutputPanel._panels.keys())
+
+
+class TestCase_SelectionSnapshot(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.view = make_view([(0, 3), (4, 7), (8, 11)], "one two six")
+        self.snapshot = executepscommand.SelectionSnapshot(self.view)
+
+    def test_TextsAreReadInOneCall(self):
+        self.assertEquals(["one", "two", "six"], self.snapshot.texts())
+        self.assertEquals(1, self.view.substr.call_count)
+
+    def test_DistantRegionsAreReadOneByOne(self):
+        view = make_view([(0, 1), (1000000, 1000001)])
+        executepscommand.SelectionSnapshot(view).texts()
+
+        self.assertEquals(2, view.substr.call_count)
+
+
+class TestCase_FilterRun(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.view = make_view([(0, 2), (3, 5), (6, 8)])
+        self.on_finished = mock.Mock()
+        self.run = executepscommand.FilterRun([self.view], "cmd", None, self.on_finished)
+        self.run.edits = ["edit"]
+        self.run.offsets = [0]
+        self.run.snapshots = [snapshot(self.view)]
+
+    def frame(self, kind, i, text):
+        return "%s %d %s\n" % (kind, i, base64.b64encode(text))
+
+    def test_RegionsAreReplacedAsFramesArrive(self):
+        self.run.on_line(0, self.frame("out", 1, "ONE\n"))
+
+        self.view.replace.assert_called_once_with("edit", Region(3, 5), "ONE")
+
+    def test_FramesOfLaterBatchesAreOffset(self):
+        self.run.on_line(2, self.frame("out", 0, "TWO\n"))
+
+        self.view.replace.assert_called_once_with("edit", Region(6, 8), "TWO")
+
+    def test_RegionsFollowEditsMadeDuringTheRun(self):
+        # Someone typed 10 characters at the start of the view.
+        track(self.view, [(10, 12), (13, 15), (16, 18)])
+
+        self.run.on_line(0, self.frame("out", 2, "TWO\n"))
+
+        self.view.replace.assert_called_once_with("edit", Region(16, 18), "TWO")
+
+    def test_FramesArrivingTogetherAreAppliedInOneCallback(self):
+        callbacks = []
+        sublime.set_timeout = lambda f, delay: callbacks.append(f)
+        self.run.on_line(0, self.frame("out", 0, "ZERO\n"))
+        self.run.on_line(0, self.frame("out", 2, "TWO\n"))
+
+        self.assertEquals(1, len(callbacks))
+        callbacks[0]()
+        # The first replacement moves the second.
+        self.assertEquals([mock.call("edit", Region(0, 2), "ZERO"),
+                           mock.call("edit", Region(8, 10), "TWO")],
+                          self.view.replace.call_args_list)
+
+    def test_RegionsAreOnlyLookedUpAfterEditsByOthers(self):
+        self.run.on_line(0, self.frame("out", 0, "ZERO\n"))
+        self.run.on_line(0, self.frame("out", 1, "ONE\n"))
+        self.assertFalse(self.view.get_regions.called)
+
+        track(self.view, [(0, 4), (10, 12), (13, 15)])
+        self.run.on_line(0, self.frame("out", 2, "TWO\n"))
+
+        self.assertEquals(1, self.view.get_regions.call_count)
+        self.view.replace.assert_called_with("edit", Region(13, 15), "TWO")
+
+    def test_FramesNotYetAppliedAreAppliedBeforeTheRunEnds(self):
+        sublime.set_timeout = lambda f, delay: None
+        self.run.on_line(0, self.frame("out", 1, "ONE\n"))
+        self.run.finish("")
+
+        self.view.replace.assert_called_once_with("edit", Region(3, 5), "ONE")
+        self.on_finished.assert_called_once_with("cmd", True)
+
+    def test_FailedRegionsAreNotReplaced(self):
+        self.run.on_line(0, self.frame("err", 0, "Bad thing."))
+        track(self.view, [(5, 7), (8, 10), (11, 13)])
+        self.run.finish("")
+
+        self.assertFalse(self.view.replace.called)
+        self.view.sel().add.assert_called_once_with(Region(5, 7))
+        self.on_finished.assert_called_once_with("cmd", False)
+
+    def test_FinishingWithoutErrorsReportsSuccess(self):
+        self.run.on_line(0, self.frame("out", 0, "ONE\n"))
+        self.run.finish("")
+
+        self.on_finished.assert_called_once_with("cmd", True)
+        self.view.end_edit.assert_called_once_with("edit")
+        self.view.erase_regions.assert_any_call(executepscommand.PENDING_REGIONS_KEY)
+
+
+class TestCase_FailingFilterRun(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.old_error_message = sublime.error_message
+        sublime.error_message = mock.Mock()
+        self.view = make_view([(0, 2), (3, 5)], "ab cd")
+        self.runner = mock.Mock()
+        self.runner.name = "broken"
+        self.on_finished = mock.Mock()
+
+    def tearDown(self):
+        sublime.error_message = self.old_error_message
+        RegionTestCase.tearDown(self)
+
+    def run_filter(self):
+        finished = threading.Event()
+        self.on_finished.side_effect = lambda *args: finished.set()
+        executepscommand.FilterRun([self.view], "cmd", self.runner, self.on_finished).start()
+        finished.wait(5)
+
+    def test_UnexpectedErrorsEndTheRun(self):
+        self.runner.run_script.side_effect = UnicodeDecodeError("utf8", "\xff", 0, 1, "bad")
+
+        self.run_filter()
+
+        self.on_finished.assert_called_once_with("cmd", False)
+        self.view.end_edit.assert_called_once_with(self.view.begin_edit.return_value)
+        self.assertTrue("bad" in sublime.error_message.call_args[0][0])
+
+
+class SlowRunner(poshrunner.FakeRunner):
+    """Takes its time before reading the script, like PowerShell starting."""
+
+    def run_script(self, path, on_line=None):
+        time.sleep(0.2)
+        return poshrunner.FakeRunner.run_script(self, path, on_line)
+
+
+class TestCase_ConcurrentFilterRuns(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.runner = SlowRunner({"$_.toupper()": lambda s: s.upper(),
+                                  "$_.tolower()": lambda s: s.lower()})
+        self.views = [make_view([(0, 2)], "ab"), make_view([(0, 2)], "CD")]
+
+    def start(self, view, cmd):
+        finished = threading.Event()
+        run = executepscommand.FilterRun([view], cmd, self.runner,
+                                         lambda *args: finished.set())
+        return run.start(), finished
+
+    def test_RunsDoNotShareScripts(self):
+        started0, finished0 = self.start(self.views[0], "$_.toupper()")
+        started1, finished1 = self.start(self.views[1], "$_.tolower()")
+        finished0.wait(5)
+        finished1.wait(5)
+
+        self.assertTrue(started0 and started1)
+        self.views[0].replace.assert_called_once_with(self.views[0].begin_edit.return_value,
+                                                      Region(0, 2), "AB")
+        self.views[1].replace.assert_called_once_with(self.views[1].begin_edit.return_value,
+                                                      Region(0, 2), "cd")
+
+    def test_ViewsAreFilteredByOneRunAtATime(self):
+        started0, finished0 = self.start(self.views[0], "$_.toupper()")
+        started1, finished1 = self.start(self.views[0], "$_.tolower()")
+        finished0.wait(5)
+
+        self.assertTrue(started0)
+        self.assertFalse(started1)
+        self.assertEquals(1, self.views[0].begin_edit.call_count)
+        started2, finished2 = self.start(self.views[0], "$_.tolower()")
+        finished2.wait(5)
+        self.assertTrue(started2)
+
+    def test_RegionsGoThroughOneRunOfThePipeline(self):
+        view = make_view([(i, i + 1) for i in range(100)], "x" * 100)
+        self.runner.run_script = mock.Mock(wraps=self.runner.run_script)
+
+        self.start(view, "$_.toupper()")[1].wait(5)
+
+        self.assertEquals(1, self.runner.run_script.call_count)
+        self.assertEquals(100, view.replace.call_count)
+
+
+class TestCase_MultiViewFilterRun(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.views = [make_view([(0, 1), (2, 3)]), make_view([]), make_view([(5, 6)])]
+        self.run = executepscommand.FilterRun(self.views, "cmd", None, mock.Mock())
+        self.run.edits = ["edit0", "edit1", "edit2"]
+        self.run.offsets = [0, 2, 2]
+        self.run.snapshots = map(snapshot, self.views)
+
+    def test_OutputsAreRoutedToTheirViews(self):
+        self.run.on_line(0, "out 1 %s\n" % base64.b64encode("A1\n"))
+        self.run.on_line(0, "out 2 %s\n" % base64.b64encode("C0\n"))
+
+        self.views[0].replace.assert_called_once_with("edit0", Region(2, 3), "A1")
+        self.views[2].replace.assert_called_once_with("edit2", Region(5, 6), "C0")
+        self.assertFalse(self.views[1].replace.called)
+
+
+class TestCase_RunPowershellInAllViews(RegionTestCase):
+
+    def setUp(self):
+        RegionTestCase.setUp(self)
+        self.views = [make_view([(0, 2)]), make_view([(3, 3), (5, 5)])]
+        self.views[0].file_name.return_value = os.path.abspath("a.txt")
+        self.views[1].file_name.return_value = os.path.abspath("b.txt")
+        window = mock.Mock()
+        window.views.return_value = self.views
+        self.command = executepscommand.RunPowershellInAllViews(window)
+        self.patcher = mock.patch("executepscommand.FilterRun")
+        self.FilterRun = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        RegionTestCase.tearDown(self)
+
+    def filtered_views(self, files=None):
+        self.command.on_done(u"$_", files, poshrunner.FakeRunner())
+        return self.FilterRun.call_args[0][0]
+
+    def test_ViewsWithOnlyCaretsAreSkipped(self):
+        self.assertEquals(self.views[:1], self.filtered_views())
+
+    def test_NamedViewsAreFilteredEvenWithOnlyCarets(self):
+        self.assertEquals(self.views[1:], self.filtered_views(["b.txt"]))
+
+
+class TestCase_FilterFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.runner = poshrunner.FakeRunner({"$_.toupper()": self.toupper})
+        self.paths = [self.write("a.txt", "one\n"),
+                      self.write(os.path.join("sub", "b.txt"), "two\r\nlines\r\n"),
+                      self.write("c.txt", codecs.BOM_UTF8 + "three"),
+                      self.write("bad.txt", "fail")]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def toupper(self, s):
+        if s == "fail":
+            raise ValueError("Bad thing.")
+        return s.upper()
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_FilesAreFilteredInPlace(self):
+        stats = executepscommand.filter_files(self.paths, "$_.toupper()", self.runner,
+                                              workers=2, batch_size=1)
+
+        self.assertEquals(3, stats["files"])
+        self.assertEquals(["ONE\n", "TWO\r\nLINES\r\n", codecs.BOM_UTF8 + "THREE", "fail"],
+                          map(self.read, self.paths))
+
+    def test_PermissionsAreKept(self):
+        os.chmod(self.paths[0], 0755)
+
+        executepscommand.filter_files(self.paths, "$_.toupper()", self.runner)
+
+        self.assertEquals("ONE\n", self.read(self.paths[0]))
+        self.assertEquals(0755, os.stat(self.paths[0]).st_mode & 0777)
+
+    def test_FailuresAreReportedByFile(self):
+        stats = executepscommand.filter_files(self.paths, "$_.toupper()", self.runner)
+
+        self.assertEquals({self.paths[3]: "Bad thing."}, stats["errors"])
+
+    def test_UnexpectedErrorsFailTheirBatch(self):
+        self.runner.run_script = mock.Mock(
+                    side_effect=UnicodeDecodeError("utf8", "\xff", 0, 1, "bad"))
+
+        with mock.patch("traceback.print_exc"):
+            stats = executepscommand.filter_files(self.paths, "$_.toupper()", self.runner,
+                                                  workers=2, batch_size=2)
+
+        self.assertEquals(0, stats["files"])
+        self.assertEquals(sorted(self.paths), sorted(stats["errors"]))
+        self.assertTrue("bad" in stats["errors"][self.paths[0]])
+
+    def test_ResultsCanGoToAnotherDirectory(self):
+        out = os.path.join(self.dir, "out")
+
+        executepscommand.filter_files(self.paths, "$_.toupper()", self.runner, output_dir=out)
+
+        self.assertEquals("one\n", self.read(self.paths[0]))
+        self.assertEquals("TWO\r\nLINES\r\n", self.read(os.path.join(out, "sub", "b.txt")))
+
+    def test_LargeFilesAreMapped(self):
+        old_threshold = executepscommand.FILTER_FILES_MMAP_THRESHOLD
+        executepscommand.FILTER_FILES_MMAP_THRESHOLD = 0
+        try:
+            self.assertEquals((u"three", True), executepscommand.read_text_file(self.paths[2]))
+        finally:
+            executepscommand.FILTER_FILES_MMAP_THRESHOLD = old_threshold
+
+
+class TestCase_IntrinsicCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.command = executepscommand.RunPowershell(mock.Mock())
+        self.reset = threading.Event()
+        self.patcher = mock.patch("poshrunner.reset_sessions",
+                                  mock.Mock(side_effect=lambda session: self.reset.set()))
+        self.reset_sessions = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_ResetOnlyResetsTheCurrentSession(self):
+        self.assertTrue(self.command._parse_intrinsic_commands("!reset", None, "s"))
+
+        self.reset.wait(5)
+        self.reset_sessions.assert_called_once_with("s")
+
+    def test_ResetOutsideOfASessionDoesNothing(self):
+        self.assertTrue(self.command._parse_intrinsic_commands("!reset", None))
+
+        self.assertFalse(self.reset_sessions.called)
+
+
 class TestCase_HistoryFunctionality(unittest.TestCase):
 
     def setUp(self):
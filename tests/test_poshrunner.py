@@ -0,0 +1,244 @@
+import unittest
+import os
+import sys
+import codecs
+import shutil
+import tempfile
+import mock
+import sublime
+
+sublime.packagesPath = mock.Mock()
+sublime.packagesPath.return_value = "XXX"
+
+import poshrunner
+import executepscommand
+
+
+class TestCase_GetRunner(unittest.TestCase):
+
+    def test_RunnersAreLookedUpByName(self):
+        self.assertTrue(isinstance(poshrunner.get_runner("pwsh"),
+                                   poshrunner.PwshRunner))
+
+    def test_RunnerInstancesArePassedThrough(self):
+        runner = poshrunner.FakeRunner()
+        self.assertTrue(poshrunner.get_runner(runner) is runner)
+
+    def test_SessionsRunInAHost(self):
+        runner = poshrunner.get_runner("pwsh", session="s")
+
+        self.assertTrue(isinstance(runner, poshrunner.HostRunner))
+        self.assertEquals("s", runner.session)
+
+    def test_UnknownRunnerRaises(self):
+        self.assertRaises(poshrunner.UnknownRunnerError,
+                          poshrunner.get_runner, "cmd.exe")
+
+
+class TestCase_ProcessRunners(unittest.TestCase):
+
+    def test_ScriptCmdLineRunsFile(self):
+        actual = poshrunner.PwshRunner().script_cmd_line("psbuff.ps1")
+
+        self.assertEquals("pwsh", actual[0])
+        self.assertEquals(["-file", "psbuff.ps1"], actual[-2:])
+
+    def test_WindowsPowershellRunsCommandsInSta(self):
+        actual = poshrunner.WindowsPowershellRunner().command_cmd_line("dir")
+
+        self.assertTrue("-sta" in actual)
+        self.assertEquals(["-command", "dir"], actual[-2:])
+
+
+# Speaks HostProcess' protocol like HOST_SCRIPT, but runs no PowerShell:
+# it echoes each script along with how many runs its session has seen,
+# or writes what follows "write " as it is.
+PYTHON_HOST = r"""
+import sys, base64
+runs = {}
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    verb, session, token, data = line.rstrip("\n").split("\t")
+    script = base64.b64decode(data)
+    errors = ""
+    if verb == "reset":
+        runs.clear()
+    elif verb == "parse":
+        if "(" in script and ")" not in script:
+            errors = "%d\tMissing ')' in method call." % script.index("(")
+    else:
+        if script == "exit":
+            sys.exit(1)
+        runs[session] = runs.get(session, 0) + 1
+        if script.startswith("write "):
+            sys.stdout.write(script[len("write "):])
+        else:
+            sys.stdout.write("%s %d\n" % (script, session and runs[session] or 1))
+        errors = script == "bad" and "Bad thing." or ""
+    sys.stdout.write("done %s %s\n" % (token, base64.b64encode(errors)))
+    sys.stdout.flush()
+"""
+
+
+class PythonHostRunner(poshrunner.ProcessRunner):
+    name = "python-host"
+
+    def host_cmd_line(self):
+        return [sys.executable, "-c", PYTHON_HOST]
+
+    def decode(self, data):
+        return data.decode('utf-8')
+
+
+class TestCase_HostRunner(unittest.TestCase):
+
+    def tearDown(self):
+        host = poshrunner._hosts.pop(PythonHostRunner.name, None)
+        if host and host.is_running():
+            host.proc.stdin.close()
+            host.proc.wait()
+
+    def test_HostIsReused(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+        runner.run_command("one")
+        proc = runner.host().proc
+
+        self.assertEquals((u"two 1\n", u""), runner.run_command("two"))
+        self.assertTrue(runner.host().proc is proc)
+
+    def test_SessionStateIsKeptUntilReset(self):
+        runner = poshrunner.HostRunner(PythonHostRunner(), session="s")
+        runner.run_command("one")
+
+        self.assertEquals(u"two 2\n", runner.run_command("two")[0])
+        poshrunner.reset_sessions("s")
+        self.assertEquals(u"three 1\n", runner.run_command("three")[0])
+
+    def test_SyntaxIsCheckedByTheRunningHost(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+        runner.run_command("one")
+
+        self.assertEquals((10, u"Missing ')' in method call."),
+                          runner.check_syntax(u"$_.toupper("))
+        self.assertEquals((None, True), runner.parse(u"$_.toupper()"))
+
+    def test_SyntaxIsCheckedLocallyWhileTheHostIsBusy(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+        runner.run_command("one")
+
+        with runner.host().lock:
+            self.assertEquals(((10, u"Missing closing ')'."), False),
+                              runner.parse(u"$_.toupper("))
+
+    def test_SyntaxIsCheckedLocallyUntilTheHostRuns(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+
+        self.assertEquals(((10, u"Missing closing ')'."), False), runner.parse(u"$_.toupper("))
+        self.assertFalse(runner.host().is_running())
+
+    def test_ErrorsAreReported(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+
+        self.assertEquals(u"Bad thing.", runner.run_command("bad")[1])
+
+    def test_DeadHostIsRestarted(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+
+        out, error = runner.run_command("exit")
+
+        self.assertTrue(error)
+        self.assertEquals(u"one 1\n", runner.run_command("one")[0])
+
+    def test_LostSessionsAreReported(self):
+        runner = poshrunner.HostRunner(PythonHostRunner(), session="s")
+        other = poshrunner.HostRunner(PythonHostRunner(), session="t")
+        runner.run_command("one")
+        other.run_command("one")
+
+        self.assertTrue(u"Session 's' was lost" in runner.run_command("exit")[1])
+        self.assertEquals(u"two 1\n", runner.run_command("two")[0])
+        self.assertTrue(u"session 't' was lost" in other.run_command("two")[1])
+        self.assertEquals(u"three 1\n", other.run_command("three")[0])
+
+    def test_OutputCannotEndTheRequest(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+
+        self.assertEquals((u"done QQ==\n", u""), runner.run_command("write done QQ==\n"))
+        self.assertEquals(u"one 1\n", runner.run_command("one")[0])
+
+    def test_ScriptFilesAreSentInPieces(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+        fd, path = tempfile.mkstemp(suffix=".ps1")
+        os.write(fd, codecs.BOM_UTF8 + u"write h\xe9llo w\xf6rld\n".encode('utf-8'))
+        os.close(fd)
+        try:
+            with mock.patch.object(poshrunner.HostProcess, "CHUNK_SIZE", 3):
+                self.assertEquals((u"h\xe9llo w\xf6rld\n", u""), runner.run_script(path))
+        finally:
+            os.remove(path)
+
+    def test_OutputWithoutNewlineIsKept(self):
+        runner = poshrunner.HostRunner(PythonHostRunner())
+
+        self.assertEquals((u"no newline", u""), runner.run_command("write no newline"))
+
+
+class TestCase_FakeRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_get_path = executepscommand.get_path_to_posh_script
+        executepscommand.get_path_to_posh_script = lambda: os.path.join(self.dir, "psbuff.ps1")
+
+        self.view = mock.Mock()
+        self.view.substr.side_effect = lambda x: x
+
+    def tearDown(self):
+        executepscommand.get_path_to_posh_script = self.old_get_path
+        shutil.rmtree(self.dir)
+
+    def filter(self, regions, runner, on_line=None):
+        texts = [self.view.substr(r) for r in regions]
+        return executepscommand.filter_thru_posh(texts, "$_.toupper()", runner, on_line)
+
+    def test_FilterRunsOnEveryRegion(self):
+        runner = poshrunner.FakeRunner({"$_.toupper()": lambda s: s.upper()})
+
+        out, error = self.filter([u"one", u"it's", u"a\nb"], runner)
+
+        self.assertEquals("", error)
+        self.assertEquals(({0: u"ONE", 1: u"IT'S", 2: u"A\nB"}, {}),
+                          executepscommand.get_outputs(out))
+
+    def test_OutputIsStreamedLineByLine(self):
+        runner = poshrunner.FakeRunner({"$_.toupper()": lambda s: s.upper()})
+        lines = []
+
+        out, error = self.filter([u"one", u"two"], runner, lines.append)
+
+        self.assertEquals("", out)
+        self.assertEquals([("out", 0, u"ONE"), ("out", 1, u"TWO")],
+                          map(executepscommand.parse_frame, lines))
+
+    def test_FailingRegionsAreReportedByIndex(self):
+        def toupper(s):
+            if not s:
+                raise ValueError("empty")
+            return s.upper()
+        runner = poshrunner.FakeRunner({"$_.toupper()": toupper})
+
+        out, error = self.filter([u"one", u""], runner)
+
+        self.assertEquals(({0: u"ONE"}, {1: u"empty"}),
+                          executepscommand.get_outputs(out))
+
+    def test_UnknownCommandFailsTheWholeScript(self):
+        out, error = self.filter([u"one"], poshrunner.FakeRunner())
+
+        self.assertTrue(error)
+
+
+if __name__ == "__main__":
+    unittest.main()
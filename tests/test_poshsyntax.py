@@ -0,0 +1,53 @@
+import unittest
+
+import poshsyntax
+
+
+class TestCase_FindSyntaxError(unittest.TestCase):
+
+    def assertValid(self, cmd):
+        self.assertEquals(None, poshsyntax.find_syntax_error(cmd))
+
+    def assertError(self, offset, message, cmd):
+        self.assertEquals((offset, message), poshsyntax.find_syntax_error(cmd))
+
+    def test_ValidPipelinesPass(self):
+        self.assertValid(u"$_.toupper()")
+        self.assertValid(u'$_.replace("a", "b") | sort')
+        self.assertValid(u"% { $_ * 2 } | select -first 3")
+        self.assertValid(u"[int]$_ + @{a=1}.a")
+        self.assertValid(u"a || b")
+
+    def test_UnbalancedBracketsAreFound(self):
+        self.assertError(10, u"Missing closing ')'.", u"$_.toupper(")
+        self.assertError(7, u"Missing closing '}'.", u"$_ | % { $_ * 2 ")
+        self.assertError(6, u"Unexpected token ']' in expression or statement.", u"@(1,2)]")
+
+    def test_UnterminatedStringsAreFound(self):
+        self.assertError(0, u"The string is missing the terminator: '.", u"'it''s")
+        self.assertError(6, u'The string is missing the terminator: ".', u'"a" + "b')
+
+    def test_EscapedQuotesDontEndStrings(self):
+        self.assertValid(u"'it''s'")
+        self.assertValid(u'"a`"b" + "c""d"')
+
+    def test_BracketsInStringsAndCommentsAreIgnored(self):
+        self.assertValid(u"'(' + \"{\" # )")
+        self.assertValid(u"<# ) #> $_")
+
+    def test_SubexpressionsInStringsAreChecked(self):
+        self.assertValid(u'"a $($_.length) b"')
+        self.assertError(13, u'The string is missing the terminator: ".', u'"a $($_.len b"')
+
+    def test_EmptyPipeElementsAreFound(self):
+        self.assertError(0, u"An empty pipe element is not allowed.", u"| sort")
+        self.assertError(5, u"An empty pipe element is not allowed.", u"sort |")
+        self.assertError(7, u"An empty pipe element is not allowed.", u"sort | | x")
+
+    def test_HereStringsMustBeTerminated(self):
+        self.assertValid(u"@'\n)\n'@")
+        self.assertError(0, u"The string is missing the terminator: '@.", u"@'\n)")
+
+
+if __name__ == "__main__":
+    unittest.main()
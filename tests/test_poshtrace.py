@@ -0,0 +1,104 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+import poshtrace
+
+
+class TestCase_Span(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "pstrace.jsonl")
+
+    def tearDown(self):
+        for handler in poshtrace.get_logger(self.path).handlers:
+            handler.close()
+        del poshtrace._loggers[self.path]
+        shutil.rmtree(self.dir)
+
+    def spans(self):
+        return [json.loads(line) for line in open(self.path)]
+
+    def test_EndedSpansAreWrittenAsJsonLines(self):
+        span = poshtrace.Span(self.path, u"$_.toupper()", "filter", "pwsh")
+        span.add(regions=3)
+        span.end("ok")
+
+        [record] = self.spans()
+        self.assertEquals(poshtrace.command_hash(u"$_.toupper()"), record["command"])
+        self.assertEquals(3, record["regions"])
+        self.assertEquals("ok", record["status"])
+
+    def test_CommandsAreHashed(self):
+        span = poshtrace.Span(self.path, u"get-secret", "command", "pwsh")
+        span.end("ok")
+
+        self.assertFalse("get-secret" in open(self.path).read())
+
+    def test_BatchesMeasureBytesAndPhases(self):
+        span = poshtrace.Span(self.path, u"cmd", "filter", "fake")
+        lines = []
+        batch = span.batch(lines.append)
+        batch.on_line("out 0 T05F\n")
+        batch.done(100)
+
+        self.assertEquals(["out 0 T05F\n"], lines)
+        self.assertEquals(1, span.fields["batches"])
+        self.assertEquals(100, span.fields["bytes_in"])
+        self.assertEquals(len("out 0 T05F\n"), span.fields["bytes_out"])
+        self.assertTrue(span.fields["spawn"] >= 0 and span.fields["execution"] >= 0)
+
+    def test_TimedFunctionsAddTheirDuration(self):
+        span = poshtrace.Span(self.path, u"cmd", "filter", "fake")
+
+        self.assertEquals(2, span.timed("apply", lambda x: x * 2)(1))
+        self.assertTrue(span.fields["apply"] >= 0)
+
+    def test_TraceFileIsRotated(self):
+        old_max = poshtrace.TRACE_MAX_BYTES
+        poshtrace.TRACE_MAX_BYTES = 500
+        try:
+            for i in range(20):
+                poshtrace.Span(self.path, u"cmd", "filter", "fake").end("ok")
+        finally:
+            poshtrace.TRACE_MAX_BYTES = old_max
+
+        spans = list(poshtrace.read_spans(self.path))
+        self.assertTrue(os.path.exists(self.path + ".1"))
+        self.assertFalse(os.path.exists(self.path + ".%d" % (poshtrace.TRACE_BACKUPS + 1)))
+        self.assertTrue(0 < len(spans) < 20)
+        started = [span["started"] for span in spans]
+        self.assertEquals(sorted(started), started)
+
+
+class TestCase_Summary(unittest.TestCase):
+
+    def span(self, command, total, status="ok"):
+        return {"command": command, "status": status, "regions": 1, "total": total}
+
+    def test_PercentilesArePerCommand(self):
+        spans = [self.span("a", t / 100.0) for t in range(1, 101)] + [self.span("b", 5.0)]
+
+        summary = poshtrace.summarize(spans)
+
+        self.assertEquals(100, summary["a"]["runs"])
+        self.assertEquals({50: 0.5, 90: 0.9, 99: 0.99}, summary["a"]["phases"]["total"])
+        self.assertEquals(5.0, summary["b"]["phases"]["total"][50])
+
+    def test_StatusesAreCounted(self):
+        spans = [self.span("a", 1), self.span("a", 1, "failed"), self.span("a", 1)]
+
+        self.assertEquals({"ok": 2, "failed": 1}, poshtrace.summarize(spans)["a"]["statuses"])
+
+    def test_SlowestCommandsAreReportedFirst(self):
+        report = poshtrace.format_summary(poshtrace.summarize(
+                        [self.span("fast", 0.1), self.span("slow", 2.0)]))
+
+        self.assertTrue(report.index("slow") < report.index("fast"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import unittest
+import os
+import stat
+import shutil
+import tempfile
+import time
+import zipfile
+
+import mock
+import multiprocessing
+from distutils import log
+
+import setup
+
+
+class TestCase_WriteZipfile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "out.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entry(self, arcname, contents, mtime=None, mode=stat.S_IFREG | 0644):
+        md5, crc, size, data = setup.compress_data(contents)
+        return (arcname, mtime, mode, crc, size, data)
+
+    def test_EntriesCanBeReadBack(self):
+        setup.write_zipfile(self.path, [self.entry("a.py", "print 1\n" * 100),
+                                        self.entry(os.path.join("sub", "b.txt"), ""),
+                                        self.entry("c.bin", os.urandom(1000))])
+
+        z = zipfile.ZipFile(self.path)
+        self.assertEquals(None, z.testzip())
+        self.assertEquals(["a.py", "sub/b.txt", "c.bin"], z.namelist())
+        self.assertEquals("print 1\n" * 100, z.read("a.py"))
+        self.assertEquals("", z.read("sub/b.txt"))
+        self.assertEquals(zipfile.ZIP_DEFLATED, z.getinfo("a.py").compress_type)
+
+    def test_ModesAndTimestampsAreStored(self):
+        mtime = 1300000000  # an even number of seconds, as zip stores them
+        setup.write_zipfile(self.path, [self.entry("a.py", "x", mtime, stat.S_IFREG | 0755),
+                                        self.entry("b.py", "y")])
+
+        z = zipfile.ZipFile(self.path)
+        a, b = z.infolist()
+        self.assertEquals(stat.S_IFREG | 0755, a.external_attr >> 16)
+        self.assertEquals(time.localtime(mtime)[:6], a.date_time)
+        self.assertEquals((1980, 1, 1, 0, 0, 0), b.date_time)
+
+
+def get_pid(item):
+    return os.getpid()
+
+
+class TestCase_ParallelMap(unittest.TestCase):
+
+    def test_ResultsComeBackInOrder(self):
+        self.assertEquals([1, 4, 9], setup.parallel_map(abs, [1, 4, 9], 2))
+
+    def test_WorkersCanBeFreshForEveryChunk(self):
+        if multiprocessing.current_process().daemon:
+            self.skipTest("running in a worker, which can't start workers")
+        pids = setup.parallel_map(get_pid, range(4), 2, 1, 1)
+
+        self.assertEquals(4, len(set(pids)))
+        self.assertFalse(os.getpid() in pids)
+
+
+class TestCase_MakeSublimePackage(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        self.threshold = log.set_threshold(log.WARN)
+        self.files = [self.write("a.py", "print 'a'\n"),
+                      self.write(os.path.join("sub", "b.py"), "print 'b'\n")]
+        self.mapped = []
+        self.patcher = mock.patch("setup.parallel_map", self.parallel_map)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        log.set_threshold(self.threshold)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def parallel_map(self, func, items, *args):
+        self.mapped.append((func.__name__, list(items)))
+        return map(func, items)
+
+    def write(self, name, data):
+        if os.path.dirname(name) and not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        f = open(name, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return name
+
+    def build(self, **kwargs):
+        del self.mapped[:]
+        return setup.make_sublime_package(os.path.join("dist", "Pkg"), self.files,
+                                          cache_dir="cache", **kwargs)
+
+    def compressed(self):
+        return [items for name, items in self.mapped if name == "compress_file"]
+
+    def read(self, name):
+        return zipfile.ZipFile(os.path.join("dist", "Pkg.sublime-package")).read(name)
+
+    def test_ArchiveHoldsFilesAndExtras(self):
+        self.build(extra_files=[("package-metadata.json", "{}")])
+
+        self.assertEquals("print 'a'\n", self.read("a.py"))
+        self.assertEquals("print 'b'\n", self.read("sub/b.py"))
+        self.assertEquals("{}", self.read("package-metadata.json"))
+
+    def test_UnchangedFilesAreNotCompressedAgain(self):
+        self.build()
+        self.build()
+
+        self.assertEquals([[]], self.compressed())
+        self.assertEquals("print 'a'\n", self.read("a.py"))
+
+    def test_ChangedFilesAreCompressedAgain(self):
+        self.build()
+        self.write("a.py", "print 'changed'\n")
+        os.utime("a.py", (0, 0))
+        self.build()
+
+        self.assertEquals([["a.py"]], self.compressed())
+        self.assertEquals("print 'changed'\n", self.read("a.py"))
+
+    def test_TouchedFilesAreReusedByContents(self):
+        self.build()
+        os.utime("a.py", (0, 0))
+        self.build()
+
+        self.assertEquals([("hash_file", ["a.py"]), ("compress_file", [])], self.mapped)
+
+    def test_MissingCacheEntriesAreRebuilt(self):
+        self.build()
+        for name in os.listdir("cache"):
+            if name.endswith(".z"):
+                os.remove(os.path.join("cache", name))
+        self.build()
+
+        self.assertEquals([sorted(self.files)], map(sorted, self.compressed()))
+        self.assertEquals("print 'b'\n", self.read("sub/b.py"))
+
+    def test_DeterministicBuildReplacesNormalBuild(self):
+        self.build()
+        self.assertFalse(os.path.exists(os.path.join("dist", "Pkg.sublime-package.sha256")))
+
+        self.build(deterministic=1)
+
+        z = zipfile.ZipFile(os.path.join("dist", "Pkg.sublime-package"))
+        self.assertEquals([(1980, 1, 1, 0, 0, 0)] * 2, [i.date_time for i in z.infolist()])
+
+    def test_UpToDateDeterministicBuildIsKept(self):
+        zip_filename, digest = self.build(deterministic=1)
+        os.utime(zip_filename, (1000000000, 1000000000))
+
+        self.assertEquals(digest, self.build(deterministic=1)[1])
+        self.assertEquals(1000000000, os.path.getmtime(zip_filename))
+
+    def test_StaleCacheEntriesAreDeleted(self):
+        self.build()
+        self.write("a.py", "print 'changed'\n")
+        os.utime("a.py", (0, 0))
+        self.build()
+
+        self.assertEquals(2, len([n for n in os.listdir("cache") if n.endswith(".z")]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 
 import _setuptestenv
 import sys
@@ -16,6 +17,10 @@ import sublimeplugin
 # Add your tests below here.
 #===============================================================================
 
+import os
+import shutil
+import tempfile
+import threading
 import sublimepath
 
 class RootAtPackagesDirFunction(unittest.TestCase):
@@ -33,5 +38,80 @@ class RootAtPackagesDirFunction(unittest.TestCase):
         self.assertEquals(actual, "?????\\XXX\\YYY")
 
 
+class AtomicWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "pshist.txt")
+        open(self.path, 'wb').write("old")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testReplaceFileReplacesContents(self):
+        sublimepath.replaceFile(self.path, "new")
+        self.assertEquals("new", open(self.path, 'rb').read())
+        self.assertEquals(["pshist.txt"], os.listdir(self.dir))
+
+    def testFailedWriteLeavesOldContents(self):
+        def write():
+            with sublimepath.atomicWrite(self.path) as f:
+                f.write("half")
+                raise ValueError
+        self.assertRaises(ValueError, write)
+        self.assertEquals("old", open(self.path, 'rb').read())
+        self.assertEquals(["pshist.txt"], os.listdir(self.dir))
+
+    def testGroupCommitKeepsLatestData(self):
+        writer = sublimepath.GroupCommit(delay=60)
+        errors = []
+        writer.write(self.path, "first", errors.append)
+        writer.write(self.path, "second", errors.append)
+        writer.flush()
+        self.assertEquals("second", open(self.path, 'rb').read())
+        self.assertEquals([None, None], errors)
+
+    def testGroupCommitReportsErrors(self):
+        writer = sublimepath.GroupCommit(delay=60)
+        errors = []
+        writer.write(os.path.join(self.dir, "missing", "x"), "data", errors.append)
+        writer.flush()
+        self.assertTrue(isinstance(errors[0], EnvironmentError))
+
+    def testPermissionsAreKept(self):
+        os.chmod(self.path, 0751)
+        sublimepath.replaceFile(self.path, "new")
+        with sublimepath.atomicWrite(self.path) as f:
+            f.write("newer")
+        writer = sublimepath.GroupCommit(delay=60)
+        writer.write(self.path, "newest")
+        writer.flush()
+        self.assertEquals(0751, os.stat(self.path).st_mode & 0777)
+
+    def testNewFilesGetTheDefaultPermissions(self):
+        created = os.path.join(self.dir, "created")
+        open(created, 'wb').close()
+        path = os.path.join(self.dir, "pshist2.txt")
+        sublimepath.replaceFile(path, "new")
+        self.assertEquals(os.stat(created).st_mode & 0777,
+                          os.stat(path).st_mode & 0777)
+
+    def testUmaskIsReadWithoutChangingIt(self):
+        if not os.path.exists('/proc/self/status'):
+            return
+        mask = os.umask(022)
+        os.umask(mask)
+        with mock.patch("os.umask") as umask:
+            self.assertEquals(mask, sublimepath._umask())
+        self.assertFalse(umask.called)
+
+    def testGroupCommitFlushesInTheBackground(self):
+        writer = sublimepath.GroupCommit(delay=0.01)
+        done = threading.Event()
+        writer.write(self.path, "new", lambda error: done.set())
+        done.wait(5)
+        self.assertEquals("new", open(self.path, 'rb').read())
+
+
 if __name__ == "__main__":
     unittest.main()